@@ -14,6 +14,11 @@
 
 '''Night Bus: Simple SSH-based build automation'''
 
+from . import distribute
+from . import events
+from . import logs
+from . import profiling
+from . import server
 from . import ssh_config
 from . import tasks
 from . import utils
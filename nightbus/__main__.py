@@ -17,6 +17,7 @@
 import pssh
 
 import argparse
+import collections
 import logging
 import os
 import sys
@@ -42,6 +43,24 @@ def argument_parser():
     parser.add_argument(
         '--log-directory', '-l', type=str, default='/var/log/ci',
         help="Base directory for log files")
+    parser.add_argument(
+        '--http-port', type=int, default=None,
+        help="Serve the status and live logs of the session over HTTP on "
+             "this port while it runs")
+    parser.add_argument(
+        '--http-address', type=str, default=nightbus.server.DEFAULT_ADDRESS,
+        help="Address for --http-port to listen on. There is no "
+             "authentication, so take care before making the server "
+             "reachable from other machines (default: %(default)s)")
+    parser.add_argument(
+        '--profile', action='store_true',
+        help="Profile Night Bus itself while running the tasks, and save the "
+             "results in the session's log directory")
+    parser.add_argument(
+        '--blocking-threshold', type=float,
+        default=nightbus.profiling.DEFAULT_BLOCKING_THRESHOLD,
+        help="With --profile, record a stack trace whenever the event loop is "
+             "blocked for longer than this many seconds (default: %(default)s)")
     # Alternative actions
     parser.add_argument(
         '--command', '-c', type=str, default=None,
@@ -50,6 +69,37 @@ def argument_parser():
     parser.add_argument(
         '--list', action='store_true',
         help="List the available tasks and hosts, then exit")
+    parser.add_argument(
+        '--history', action='store_true',
+        help="List previous results from the log directory, most recent "
+             "first. Use --tasks and --hosts to narrow the search.")
+    parser.add_argument(
+        '--failed', action='store_true',
+        help="Only list failed results with --history")
+    parser.add_argument(
+        '--diff', nargs=2, metavar=('OLD_SESSION', 'NEW_SESSION'),
+        help="Compare the logs of two sessions, showing lines matching "
+             "--pattern that are new or have disappeared, then exit")
+    parser.add_argument(
+        '--diff-against', metavar='SESSION',
+        help="After running the tasks, compare their logs with those of an "
+             "earlier session as --diff does, and add the changes to the "
+             "report")
+    parser.add_argument(
+        '--pattern', action='append',
+        help="Regular expression selecting lines to compare with --diff and "
+             "--diff-against (default: %s)" %
+             ', '.join(nightbus.logs.DEFAULT_DIFF_PATTERNS))
+    parser.add_argument(
+        '--prune', action='store_true',
+        help="Delete and compress old sessions in the log directory, and "
+             "hardlink together identical files, then exit")
+    parser.add_argument(
+        '--keep-days', type=int, default=90,
+        help="Sessions older than this are deleted by --prune (default: 90)")
+    parser.add_argument(
+        '--compress-days', type=int, default=7,
+        help="Logs older than this are compressed by --prune (default: 7)")
     return parser
 
 
@@ -68,7 +118,18 @@ def check_args(args):
         if args.tasks:
             raise RuntimeError("--list and --tasks are incompatible")
 
-    if normal_run:
+    log_actions = [action for action in ['history', 'diff', 'prune']
+                   if getattr(args, action)]
+    if log_actions:
+        normal_run = False
+        if args.command or args.list:
+            raise RuntimeError("--%s is incompatible with --command and --list"
+                               % log_actions[0])
+        if len(log_actions) > 1:
+            raise RuntimeError("--%s and --%s are incompatible" %
+                               tuple(log_actions[:2]))
+
+    if normal_run or args.prune:
         if not os.path.isdir(args.log_directory):
             raise RuntimeError("Log directory %s doesn't seem to exist. "
                                "Use --log-directory to change." %
@@ -77,9 +138,30 @@ def check_args(args):
             raise RuntimeError("Log directory %s doesn't appear writable" %
                                args.log_directory)
 
+    if args.diff_against:
+        if not normal_run:
+            raise RuntimeError("--diff-against can only be used when running "
+                               "tasks")
+        # Better to find out now than after all the tasks have run.
+        nightbus.logs.session_logs(args.log_directory, args.diff_against)
+
+    if args.profile and not normal_run:
+        raise RuntimeError("--profile can only be used when running tasks")
+
 
 def name_session():
-    return time.strftime('%Y.%m.%d-%H.%M.%S')
+    return time.strftime(nightbus.logs.SESSION_NAME_FORMAT)
+
+
+def append_diff_to_report(report_filename, log_directory, old_session,
+                          new_session, patterns=None):
+    '''Implements the --diff-against option.'''
+    results = nightbus.logs.diff_sessions(
+        log_directory, old_session, new_session,
+        patterns=patterns or nightbus.logs.DEFAULT_DIFF_PATTERNS)
+    with open(report_filename, 'a') as f:
+        f.write("\n")
+        nightbus.logs.write_diff_report(f, old_session, new_session, results)
 
 
 def run_single_command(client, hosts, command):
@@ -93,25 +175,93 @@ def run_single_command(client, hosts, command):
         print("[%s] Exit code: %i" % (host, output[host].exit_code))
 
 
+def list_tasks_and_hosts(tasks, host_config, hosts):
+    '''Implements the --list action.'''
+    print("Available hosts:\n")
+    for host in host_config.keys():
+        labels = host_config.labels.get(host)
+        if labels:
+            print("  * %s (labels: %s)" % (host, ', '.join(labels)))
+        else:
+            print("  * %s" % host)
+    print()
+    print("Available tasks, and the selected hosts they run on:\n")
+    for task in tasks:
+        task_hosts = [host for host in hosts
+                      if task.runs_on(host, host_config.labels.get(host))]
+        print("  * %s: %s" % (task.name, ', '.join(task_hosts) or '(none)'))
+
+
+def show_history(log_directory, tasks=None, hosts=None, failed=False):
+    '''Implements the --history action.'''
+    entries = nightbus.logs.read_index(log_directory)
+    status = 'failed' if failed else None
+    for entry in nightbus.logs.find_results(entries, tasks=tasks, hosts=hosts,
+                                            status=status):
+        duration = nightbus.tasks.duration_as_string(entry['duration'])
+        print("%s %s %s: %s in %s (%s)" % (
+            entry['session'], entry['run'], entry['host'], entry['status'],
+            duration, os.path.join(log_directory, entry['session'],
+                                   entry['log'])))
+
+
 def main():
     logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 
     args = argument_parser().parse_args()
 
+    check_args(args)
+
+    if args.history:
+        show_history(args.log_directory, tasks=ensure_list(args.tasks),
+                     hosts=ensure_list(args.hosts, separator=','),
+                     failed=args.failed)
+        return
+
+    if args.diff:
+        old_session, new_session = args.diff
+        results = nightbus.logs.diff_sessions(
+            args.log_directory, old_session, new_session,
+            patterns=args.pattern or nightbus.logs.DEFAULT_DIFF_PATTERNS,
+            tasks=ensure_list(args.tasks),
+            hosts=ensure_list(args.hosts, separator=','))
+        nightbus.logs.write_diff_report(sys.stdout, old_session, new_session,
+                                        results)
+        return
+
+    if args.prune:
+        nightbus.logs.prune(args.log_directory, keep_days=args.keep_days,
+                            compress_days=args.compress_days)
+        return
+
+    profiler = None
+    if args.profile:
+        # Started before the task list is read so that parsing it and
+        # distributing files are profiled too.
+        profiler = nightbus.profiling.Profiler(
+            blocking_threshold=args.blocking_threshold)
+        profiler.start()
+
+    try:
+        run_session(args, profiler)
+    finally:
+        if profiler is not None:
+            profiler.stop()
+
+
+def run_session(args, profiler=None):
+    '''Runs the selected tasks, or the --list or --command action.'''
     with open('./tasks') as f:
         tasks = nightbus.tasks.TaskList(f.read())
     with open('./hosts') as f:
         host_config = nightbus.ssh_config.SSHConfig(f.read())
 
-    check_args(args)
+    hosts = ensure_list(args.hosts, separator=',') or host_config.keys()
 
     if args.list:
-        print("Available hosts:\n\n  *", '\n  * '.join(host_config.keys()))
-        print()
-        print("Available tasks:\n\n  *", '\n  * '.join(tasks.names()))
+        list_tasks_and_hosts(tasks, host_config, hosts)
         return
 
-    hosts = ensure_list(args.hosts, separator=',') or host_config.keys()
     tasks_to_run = ensure_list(args.tasks) or tasks.names()
     logging.info("Selected tasks: %s", ','.join(tasks_to_run))
 
@@ -121,23 +271,66 @@ def main():
         run_single_command(client, hosts, args.command)
         return
 
+    if tasks.distribute:
+        failed_hosts = nightbus.distribute.distribute_files(
+            client, hosts, tasks.distribute)
+        if failed_hosts:
+            logging.warning("Failed to distribute files to: %s. No tasks will "
+                            "run on these hosts.", ', '.join(failed_hosts))
+            hosts = [host for host in hosts if host not in failed_hosts]
+            if not hosts:
+                raise RuntimeError("Failed to distribute files to any hosts")
+
     session_name = name_session()
 
     log_directory = os.path.join(args.log_directory, session_name)
     os.makedirs(log_directory, exist_ok=False)
     logging.info("Created log directory: %s", log_directory)
+    if profiler is not None:
+        profiler.output_directory = log_directory
+    # Keeps --prune away from the session until this process exits.
+    session_lock = nightbus.logs.lock_session(log_directory)
+
+    events = nightbus.events.EventStream()
+
+    report_filename = os.path.join(log_directory, 'report.txt')
+    events.subscribe(nightbus.events.ReportWriter(report_filename))
+
+    server = None
+    if args.http_port is not None:
+        server = nightbus.server.StatusServer(
+            (args.http_address, args.http_port), log_directory)
+        server.start()
+        events.subscribe(server.handle_event)
+        logging.info("Serving session status on %s port %i",
+                     args.http_address, server.server_port)
+
+    # If run_all_tasks() raises an exception, the results of the tasks which
+    # finished still arrive with the SessionFinished event.
+    results = collections.OrderedDict()
+
+    def keep_results(event):
+        if isinstance(event, nightbus.events.SessionFinished):
+            results.update(event.results)
+    events.subscribe(keep_results)
 
-    results = []
     try:
-        results = nightbus.tasks.run_all_tasks(
+        nightbus.tasks.run_all_tasks(
             client, hosts, [t for t in tasks if t.name in tasks_to_run],
-            log_directory=log_directory, force=args.force)
+            log_directory=log_directory, force=args.force,
+            host_labels=host_config.labels, events=events,
+            compress_hosts=host_config.compress_hosts)
     finally:
+        if server is not None:
+            server.stop()
         if results:
-            report_filename = os.path.join(log_directory, 'report.txt')
-            logging.info("Writing report to: %s", report_filename)
-            with open(report_filename, 'w') as f:
-                nightbus.tasks.write_report(f, results)
+            nightbus.logs.update_index(args.log_directory, session_name, results)
+            if args.diff_against:
+                append_diff_to_report(report_filename, args.log_directory,
+                                      args.diff_against, session_name,
+                                      args.pattern)
+            logging.info("Wrote report to: %s", report_filename)
+        session_lock.close()
 
 
 try:
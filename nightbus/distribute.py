@@ -0,0 +1,170 @@
+# Copyright 2017 Codethink Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Copying files from the controller to all of the hosts.
+
+Hosts which already have an identical copy of a file are skipped. In tree
+mode, hosts which have received the file send it on to other hosts, doubling
+the number of senders each round. This requires that the hosts can reach each
+other over SSH using the names they have in the hosts file, without needing a
+password.
+
+'''
+
+import gevent
+
+import logging
+import os
+import re
+import shlex
+
+from nightbus.tasks import client_for_hosts
+from nightbus.utils import file_digest
+
+
+DIGEST_RE = re.compile(r'\b[0-9a-f]{64}\b')
+
+
+def digest_command(path):
+    '''Print the SHA-256 digest of a file, if it exists.
+
+    Not every platform has `sha256sum`, so we try some alternatives.
+
+    '''
+    path = shlex.quote(path)
+    return ('if [ -f %s ]; then '
+            '(sha256sum %s || shasum -a 256 %s || openssl dgst -sha256 %s) '
+            '2>/dev/null; fi' % (path, path, path, path))
+
+
+def remote_digests(client, hosts, path):
+    '''Return a dict of the SHA-256 digest of `path` on each host.
+
+    The digest is None for hosts which don't have the file.
+
+    '''
+    host_client = client_for_hosts(client, hosts)
+    output = host_client.run_command(digest_command(path), stop_on_errors=True)
+    host_client.join(output)
+
+    digests = {}
+    for host in hosts:
+        digests[host] = None
+        for line in output[host].stdout:
+            match = DIGEST_RE.search(line)
+            if match:
+                digests[host] = match.group(0)
+    return digests
+
+
+def upload(client, hosts, distribution):
+    '''Copy the file from the controller to the given hosts.
+
+    Returns a list of the hosts that the copy failed for.
+
+    '''
+    greenlets = client_for_hosts(client, hosts).copy_file(
+        distribution.source, distribution.destination)
+    gevent.joinall(greenlets)
+
+    failed_hosts = []
+    for host, greenlet in zip(hosts, greenlets):
+        if not greenlet.successful():
+            logging.warning("Failed to copy %s to %s: %s", distribution.source,
+                            host, greenlet.exception)
+            failed_hosts.append(host)
+    return failed_hosts
+
+
+def relay(client, sender, receiver, distribution):
+    '''Copy the file from one host to another, returning True on success.'''
+    path = shlex.quote(distribution.destination)
+    cmd = 'scp -q -o BatchMode=yes %s %s:%s' % (
+        path, shlex.quote(receiver), path)
+    host_client = client_for_hosts(client, [sender])
+    output = host_client.run_command(cmd, stop_on_errors=True)
+    host_client.join(output)
+    return output[sender].exit_code == 0
+
+
+def send(client, sender, receiver, distribution):
+    if sender is None:
+        return not upload(client, [receiver], distribution)
+    return relay(client, sender, receiver, distribution)
+
+
+def distribute_file(client, hosts, distribution):
+    '''Make sure every host has an identical copy of a file.
+
+    Returns a list of the hosts that we failed to send the file to.
+
+    '''
+    digest = file_digest(distribution.source)
+    digests = remote_digests(client, hosts, distribution.destination)
+
+    have = [host for host in hosts if digests[host] == digest]
+    need = [host for host in hosts if digests[host] != digest]
+    logging.info("Distributing %s to %s: %i of %i hosts already have it",
+                 distribution.source, distribution.destination, len(have),
+                 len(hosts))
+    if not need:
+        return []
+
+    directory = os.path.dirname(distribution.destination)
+    if directory:
+        host_client = client_for_hosts(client, need)
+        host_client.join(host_client.run_command(
+            'mkdir -p %s' % shlex.quote(directory), stop_on_errors=True))
+
+    if not distribution.tree:
+        upload(client, need, distribution)
+    else:
+        # Each round, every host that has the file sends it to one that
+        # doesn't, and so does the controller, which we represent as None.
+        # If relaying fails we fall back to sending it from the controller.
+        direct = []
+        while need:
+            pairs = list(zip([None] + have, need))
+            need = need[len(pairs):]
+            jobs = [gevent.spawn(send, client, sender, receiver, distribution)
+                    for sender, receiver in pairs]
+            gevent.joinall(jobs)
+            for (sender, receiver), job in zip(pairs, jobs):
+                if job.successful() and job.value:
+                    have.append(receiver)
+                else:
+                    logging.warning("Failed to send %s from %s to %s",
+                                    distribution.destination,
+                                    sender or 'controller', receiver)
+                    direct.append(receiver)
+        if direct:
+            upload(client, direct, distribution)
+
+    digests = remote_digests(client, hosts, distribution.destination)
+    return [host for host in hosts if digests[host] != digest]
+
+
+def distribute_files(client, hosts, distributions):
+    '''Send each file to every host.
+
+    Returns a list of hosts that didn't receive every file.
+
+    '''
+    failed_hosts = []
+    for distribution in distributions:
+        working_hosts = [host for host in hosts if host not in failed_hosts]
+        if not working_hosts:
+            break
+        failed_hosts += distribute_file(client, working_hosts, distribution)
+    return failed_hosts
@@ -0,0 +1,141 @@
+# Copyright 2017 Codethink Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Events produced while running tasks.
+
+run_task() and run_all_tasks() send events to an EventStream as tasks
+progress. Anything that needs to know what is happening subscribes to the
+stream: the log files, the report and the HTTP server all work this way.
+
+To embed Night Bus in another program, you can subscribe your own callbacks,
+or iterate over the events of a session using run_session().
+
+'''
+
+import gevent
+import gevent.queue
+
+import collections
+import os
+
+import nightbus
+
+
+# A task is about to start on the given hosts.
+TaskStarted = collections.namedtuple('TaskStarted', ['name', 'hosts'])
+
+# A host produced a line of output.
+LineReceived = collections.namedtuple('LineReceived', ['name', 'host', 'line'])
+
+# A host produced a ##nightbus message.
+MessageReceived = collections.namedtuple(
+    'MessageReceived', ['name', 'host', 'message'])
+
+# A task finished on one host, with the given TaskResult.
+HostFinished = collections.namedtuple(
+    'HostFinished', ['name', 'host', 'result'])
+
+# A task finished on all hosts. The results are a dict of TaskResult objects
+# for each host.
+TaskFinished = collections.namedtuple('TaskFinished', ['name', 'results'])
+
+# All tasks have finished, or the session was interrupted. The results are a
+# nightbus.tasks.ResultStore.
+SessionFinished = collections.namedtuple('SessionFinished', ['results'])
+
+
+class EventStream():
+    '''Delivers events to each subscribed callback, in order.'''
+    def __init__(self):
+        self.subscribers = []
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        self.subscribers.remove(callback)
+
+    def emit(self, event):
+        for callback in self.subscribers:
+            callback(event)
+
+
+class LogWriter():
+    '''Subscriber which writes the output of each host to a log file.'''
+    def __init__(self, log_directory):
+        self.log_directory = log_directory
+        self.files = {}
+
+    def __call__(self, event):
+        if isinstance(event, LineReceived):
+            f = self.files[(event.name, event.host)]
+            f.write(event.line.encode('unicode-escape'))
+            f.write(b'\n')
+        elif isinstance(event, TaskStarted):
+            for host in event.hosts:
+                path = os.path.join(self.log_directory,
+                                    nightbus.tasks.log_filename(event.name, host))
+                self.files[(event.name, host)] = open(path, 'wb')
+        elif isinstance(event, HostFinished):
+            self.files.pop((event.name, event.host)).close()
+        elif isinstance(event, SessionFinished):
+            # Close any logs left open by tasks that were interrupted.
+            for f in self.files.values():
+                f.close()
+            self.files.clear()
+
+
+class ReportWriter():
+    '''Subscriber which writes the report as each task finishes.
+
+    The report file isn't created until a task has finished.
+
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def __call__(self, event):
+        if isinstance(event, TaskFinished):
+            if self.file is None:
+                self.file = open(self.path, 'w')
+            else:
+                self.file.write("\n")
+            nightbus.tasks.write_task_report(self.file, event.name,
+                                             event.results)
+            self.file.flush()
+        elif isinstance(event, SessionFinished) and self.file is not None:
+            self.file.close()
+
+
+def run_session(client, hosts, tasks, log_directory, **kwargs):
+    '''Run tasks as run_all_tasks() does, yielding each event as it happens.
+
+    The last event is always SessionFinished, even if run_all_tasks()
+    raises an exception. The exception is raised again here once all of the
+    events have been yielded.
+
+    '''
+    events = EventStream()
+    queue = gevent.queue.Queue()
+    events.subscribe(queue.put)
+
+    runner = gevent.spawn(nightbus.tasks.run_all_tasks, client, hosts, tasks,
+                          log_directory, events=events, **kwargs)
+    # A gevent queue stops iterating when it receives StopIteration.
+    runner.link(lambda greenlet: queue.put(StopIteration))
+
+    for event in queue:
+        yield event
+    runner.get()
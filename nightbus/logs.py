@@ -0,0 +1,366 @@
+# Copyright 2017 Codethink Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Management of the sessions stored in the log directory.
+
+Each session gets its own directory, named by nightbus.__main__.name_session().
+The base log directory also holds an index of every task result from every
+session, with one JSON object per line, so that it's quick to find results
+without walking the whole tree. A session is added to the index when it
+finishes. Anything which changes the index holds a lock on it, and each
+session holds a lock on its own directory while it runs.
+
+'''
+
+import collections
+import contextlib
+import fcntl
+import gzip
+import hashlib
+import json
+import logging
+import mmap
+import os
+import re
+import shutil
+import time
+
+from nightbus.tasks import log_filename
+from nightbus.utils import file_digest
+
+
+INDEX_FILENAME = 'index.jsonl'
+
+# The index itself is replaced when it's rewritten, so the lock needs a file
+# of its own.
+INDEX_LOCK_FILENAME = 'index.lock'
+
+SESSION_LOCK_FILENAME = 'session.lock'
+
+SESSION_NAME_FORMAT = '%Y.%m.%d-%H.%M.%S'
+
+DEFAULT_DIFF_PATTERNS = ['^FAIL:']
+
+
+def split_run_name(run_name):
+    '''Split a run name such as '2.gcc-test' into (2, 'gcc-test').'''
+    number, _, task_name = run_name.partition('.')
+    return int(number), task_name
+
+
+def index_entries(log_directory, session_name, all_results):
+    '''Generate index entries for the results of one session.'''
+    session_directory = os.path.join(log_directory, session_name)
+    for run_name, task_results in all_results.items():
+        for host, result in task_results.items():
+            filename = log_filename(run_name, host)
+            log_path = os.path.join(session_directory, filename)
+            yield collections.OrderedDict([
+                ('session', session_name),
+                ('run', run_name),
+                ('task', split_run_name(run_name)[1]),
+                ('host', host),
+                ('status', 'succeeded' if result.exit_code == 0 else 'failed'),
+                ('exit_code', result.exit_code),
+                ('duration', result.duration),
+                ('log', filename),
+                ('log_size', os.path.getsize(log_path)
+                             if os.path.exists(log_path) else None),
+            ])
+
+
+@contextlib.contextmanager
+def index_lock(log_directory):
+    '''Hold an exclusive lock on the index, waiting for it if necessary.'''
+    with open(os.path.join(log_directory, INDEX_LOCK_FILENAME), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+def lock_session(session_directory):
+    '''Mark a session as running, until the returned file is closed.
+
+    The lock goes away when the process exits, so a session which crashed
+    doesn't look like it's still running.
+
+    '''
+    f = open(os.path.join(session_directory, SESSION_LOCK_FILENAME), 'w')
+    fcntl.flock(f, fcntl.LOCK_EX)
+    return f
+
+
+def session_running(session_directory):
+    '''Returns True if another process holds the lock on a session.'''
+    try:
+        f = open(os.path.join(session_directory, SESSION_LOCK_FILENAME))
+    except FileNotFoundError:
+        return False
+    with f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+    return False
+
+
+def update_index(log_directory, session_name, all_results):
+    '''Add the results of a session to the index.'''
+    with index_lock(log_directory):
+        with open(os.path.join(log_directory, INDEX_FILENAME), 'a') as f:
+            for entry in index_entries(log_directory, session_name,
+                                       all_results):
+                f.write(json.dumps(entry) + '\n')
+
+
+def read_index(log_directory):
+    '''Return every entry from the index, oldest first.'''
+    try:
+        with open(os.path.join(log_directory, INDEX_FILENAME)) as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        return []
+
+
+def write_index(log_directory, entries):
+    '''Replace the index with the given entries.'''
+    index_path = os.path.join(log_directory, INDEX_FILENAME)
+    with open(index_path + '.new', 'w') as f:
+        for entry in entries:
+            f.write(json.dumps(entry) + '\n')
+    os.replace(index_path + '.new', index_path)
+
+
+def find_results(entries, tasks=None, hosts=None, status=None):
+    '''Filter index entries, returning the most recent first.'''
+    return [entry for entry in reversed(entries)
+            if (not tasks or entry['task'] in tasks)
+            and (not hosts or entry['host'] in hosts)
+            and (not status or entry['status'] == status)]
+
+
+def list_sessions(log_directory):
+    '''Return (name, start time) for each session directory, oldest first.'''
+    sessions = []
+    for name in os.listdir(log_directory):
+        if not os.path.isdir(os.path.join(log_directory, name)):
+            continue
+        try:
+            start_time = time.mktime(time.strptime(name, SESSION_NAME_FORMAT))
+        except ValueError:
+            continue
+        sessions.append((name, start_time))
+    return sorted(sessions, key=lambda session: session[1])
+
+
+def compress_file(path):
+    '''Gzip a file in place, returning the new filename.
+
+    The gzip header doesn't include the filename or modification time, so
+    identical files compress to identical output and can still be
+    deduplicated.
+
+    '''
+    compressed_path = path + '.gz'
+    with open(path, 'rb') as f_in:
+        with open(compressed_path, 'wb') as raw_out:
+            with gzip.GzipFile(filename='', mode='wb', fileobj=raw_out,
+                               mtime=0) as f_out:
+                shutil.copyfileobj(f_in, f_out)
+    shutil.copystat(path, compressed_path)
+    os.unlink(path)
+    return compressed_path
+
+
+def deduplicate_files(paths):
+    '''Replace identical files with hardlinks to a single copy.
+
+    Returns the number of bytes saved.
+
+    '''
+    # Only files of the same size can be identical, so we avoid reading files
+    # which have a unique size.
+    by_size = collections.defaultdict(list)
+    for path in paths:
+        by_size[os.path.getsize(path)].append(path)
+
+    saved = 0
+    for size, same_size_paths in by_size.items():
+        if len(same_size_paths) < 2 or size == 0:
+            continue
+        by_digest = {}
+        for path in same_size_paths:
+            original = by_digest.setdefault(file_digest(path), path)
+            if original == path or os.path.samefile(original, path):
+                continue
+            os.link(original, path + '.link')
+            os.replace(path + '.link', path)
+            saved += size
+    return saved
+
+
+def prune(log_directory, keep_days, compress_days, now=None):
+    '''Apply retention policy to the sessions in the log directory.
+
+    Sessions older than `keep_days` are deleted, and the logs of sessions
+    older than `compress_days` are compressed. Identical files in any of the
+    remaining sessions are then hardlinked together. The index is updated to
+    match.
+
+    Sessions which are still running are left alone. Sessions which aren't
+    in the index, because they crashed or are older than the index, are
+    pruned like any other.
+
+    '''
+    with index_lock(log_directory):
+        _prune(log_directory, keep_days, compress_days, now or time.time())
+
+
+def _prune(log_directory, keep_days, compress_days, now):
+    entries = read_index(log_directory)
+
+    removed_sessions = set()
+    compressed_logs = {}
+    remaining_files = []
+    for session_name, start_time in list_sessions(log_directory):
+        session_directory = os.path.join(log_directory, session_name)
+        if session_running(session_directory):
+            logging.info("Skipping session %s, which is still running",
+                         session_name)
+            continue
+
+        age_days = (now - start_time) / (24 * 60 * 60)
+
+        if age_days > keep_days:
+            logging.info("Removing session %s", session_name)
+            shutil.rmtree(session_directory)
+            removed_sessions.add(session_name)
+            continue
+
+        for filename in sorted(os.listdir(session_directory)):
+            path = os.path.join(session_directory, filename)
+            if not os.path.isfile(path):
+                continue
+            if age_days > compress_days and filename.endswith('.log'):
+                path = compress_file(path)
+                compressed_logs[(session_name, filename)] = \
+                    os.path.basename(path)
+            remaining_files.append(path)
+
+    saved = deduplicate_files(remaining_files)
+    logging.info("Deduplication saved %i bytes", saved)
+
+    new_entries = []
+    for entry in entries:
+        if entry['session'] in removed_sessions:
+            continue
+        entry['log'] = compressed_logs.get(
+            (entry['session'], entry['log']), entry['log'])
+        new_entries.append(entry)
+    write_index(log_directory, new_entries)
+
+
+def session_logs(log_directory, session_name, entries=None):
+    '''Return a dict mapping (task, host) to log path for a session.'''
+    entries = entries if entries is not None else read_index(log_directory)
+    logs = collections.OrderedDict()
+    for entry in entries:
+        if entry['session'] == session_name:
+            logs[(entry['task'], entry['host'])] = os.path.join(
+                log_directory, session_name, entry['log'])
+    if not logs:
+        raise RuntimeError("No results for session %s in the index of %s" %
+                           (session_name, log_directory))
+    return logs
+
+
+def matching_lines(path, regex):
+    '''Find the lines in a log which match a compiled bytes regex.
+
+    Returns an ordered dict mapping a hash of each line to the line, so lines
+    can be compared between logs cheaply. Uncompressed logs are memory mapped
+    so the regex can scan them without copying them into Python.
+
+    '''
+    lines = collections.OrderedDict()
+
+    def add(line):
+        lines.setdefault(hashlib.sha1(line).digest(),
+                         line.decode('unicode-escape'))
+
+    if path.endswith('.gz'):
+        with gzip.open(path, 'rb') as f:
+            for line in f:
+                if regex.search(line):
+                    add(line.rstrip(b'\n'))
+        return lines
+
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return lines
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            position = 0
+            while True:
+                match = regex.search(data, position)
+                if not match:
+                    break
+                line_start = data.rfind(b'\n', 0, match.start()) + 1
+                line_end = data.find(b'\n', match.end())
+                if line_end == -1:
+                    line_end = len(data)
+                add(data[line_start:line_end])
+                position = line_end + 1
+    return lines
+
+
+def diff_sessions(log_directory, old_session, new_session, patterns,
+                  tasks=None, hosts=None):
+    '''Compare the logs of the same tasks and hosts in two sessions.
+
+    Only lines matching one of `patterns` are compared. Returns a list of
+    (task, host, new_lines, disappeared_lines) tuples.
+
+    '''
+    regex = re.compile('|'.join('(?:%s)' % p for p in patterns).encode('utf-8'),
+                       re.MULTILINE)
+
+    entries = read_index(log_directory)
+    old_logs = session_logs(log_directory, old_session, entries)
+    new_logs = session_logs(log_directory, new_session, entries)
+
+    results = []
+    for (task, host), new_path in new_logs.items():
+        old_path = old_logs.get((task, host))
+        if old_path is None:
+            continue
+        if (tasks and task not in tasks) or (hosts and host not in hosts):
+            continue
+        old_lines = matching_lines(old_path, regex)
+        new_lines = matching_lines(new_path, regex)
+        results.append((
+            task, host,
+            [line for key, line in new_lines.items() if key not in old_lines],
+            [line for key, line in old_lines.items() if key not in new_lines]))
+    return results
+
+
+def write_diff_report(f, old_session, new_session, results):
+    '''Write a summary of the output of diff_sessions().'''
+    f.write("Changes from %s to %s:\n" % (old_session, new_session))
+    for task, host, new_lines, disappeared_lines in results:
+        f.write("\n%s on %s: %i new, %i disappeared\n" % (
+            task, host, len(new_lines), len(disappeared_lines)))
+        for line in new_lines:
+            f.write("  + %s\n" % line)
+        for line in disappeared_lines:
+            f.write("  - %s\n" % line)
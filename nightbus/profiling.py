@@ -0,0 +1,154 @@
+# Copyright 2017 Codethink Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Profiling of the Night Bus controller process.
+
+This collects three things while a session runs:
+
+  * cProfile statistics for the whole process
+  * CPU time used by each greenlet, so the cost of each of the watchers
+    started by run_task() can be seen
+  * stack traces from any time the gevent hub was blocked for longer than a
+    threshold, which is detected from a separate OS thread
+
+Profiling starts before the session directory exists, so that reading the
+task list and distributing files are covered too. The results are written to
+files in the session directory once it has been set as the output directory.
+
+'''
+
+import gevent
+import gevent.hub
+import gevent.monkey
+import greenlet
+
+import cProfile
+import collections
+import logging
+import os
+import pstats
+import sys
+import time
+import traceback
+
+
+DEFAULT_BLOCKING_THRESHOLD = 0.5
+
+
+class Profiler():
+    '''Collects profiling data for the current process.'''
+    def __init__(self, output_directory=None,
+                 blocking_threshold=DEFAULT_BLOCKING_THRESHOLD):
+        self.output_directory = output_directory
+        self.blocking_threshold = blocking_threshold
+
+        self.profile = cProfile.Profile()
+        self.cpu_time = collections.Counter()
+        self.blocking_reports = []
+
+        self._last_cpu_time = None
+        self._previous_tracer = None
+        self._last_heartbeat = None
+        self._heartbeat = None
+        self._running = False
+
+    def start(self):
+        self._running = True
+
+        self._last_cpu_time = time.thread_time()
+        self._previous_tracer = greenlet.settrace(self._trace_switch)
+
+        # The monitor must be a real thread, even if the threading module has
+        # been monkey patched, otherwise it would be blocked with the hub.
+        self._last_heartbeat = time.monotonic()
+        self._heartbeat = gevent.spawn(self._run_heartbeat)
+        get_ident, start_new_thread = gevent.monkey.get_original(
+            '_thread', ['get_ident', 'start_new_thread'])
+        start_new_thread(self._run_monitor, (get_ident(),))
+
+        self.profile.enable()
+
+    def stop(self):
+        '''Stop profiling, and write the results to the output directory.'''
+        self.profile.disable()
+
+        self._running = False
+        self._heartbeat.kill()
+        greenlet.settrace(self._previous_tracer)
+
+        if self.output_directory is None:
+            logging.warning("No session directory was created, so the "
+                            "profiling results were not saved.")
+        else:
+            self.write_results()
+
+    def _trace_switch(self, event, args):
+        if event in ('switch', 'throw'):
+            now = time.thread_time()
+            origin = args[0]
+            self.cpu_time[greenlet_name(origin)] += now - self._last_cpu_time
+            self._last_cpu_time = now
+        if self._previous_tracer:
+            self._previous_tracer(event, args)
+
+    def _run_heartbeat(self):
+        while True:
+            self._last_heartbeat = time.monotonic()
+            gevent.sleep(self.blocking_threshold / 4)
+
+    def _run_monitor(self, thread_id):
+        sleep = gevent.monkey.get_original('time', 'sleep')
+        reported_heartbeat = None
+        while self._running:
+            sleep(self.blocking_threshold / 4)
+            last_heartbeat = self._last_heartbeat
+            blocked_for = time.monotonic() - last_heartbeat
+            if (blocked_for > self.blocking_threshold and
+                    last_heartbeat != reported_heartbeat):
+                reported_heartbeat = last_heartbeat
+                frame = sys._current_frames().get(thread_id)
+                stack = ''.join(traceback.format_stack(frame)) if frame else ''
+                self.blocking_reports.append((time.time(), blocked_for, stack))
+
+    def write_results(self):
+        stats_path = os.path.join(self.output_directory, 'profile.pstats')
+        self.profile.dump_stats(stats_path)
+
+        summary_path = os.path.join(self.output_directory, 'profile.txt')
+        with open(summary_path, 'w') as f:
+            f.write("CPU time per greenlet:\n\n")
+            for name, seconds in self.cpu_time.most_common():
+                f.write("  %10.3fs  %s\n" % (seconds, name))
+
+            f.write("\nHub blocked for more than %.3fs: %i times\n\n" %
+                    (self.blocking_threshold, len(self.blocking_reports)))
+            for timestamp, blocked_for, stack in self.blocking_reports:
+                f.write("At %s, blocked for at least %.3fs in:\n%s\n" % (
+                    time.strftime('%H:%M:%S', time.localtime(timestamp)),
+                    blocked_for, stack))
+
+            f.write("Functions by cumulative time:\n\n")
+            stats = pstats.Stats(self.profile, stream=f)
+            stats.sort_stats('cumulative').print_stats(50)
+
+        logging.info("Wrote profiling results to: %s, %s", summary_path,
+                     stats_path)
+
+
+def greenlet_name(g):
+    if isinstance(g, gevent.hub.Hub):
+        return 'hub'
+    if g.parent is None:
+        return 'main'
+    return getattr(g, 'name', None) or repr(g)
@@ -0,0 +1,281 @@
+# Copyright 2017 Codethink Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Minimal HTTP server for following a Night Bus session as it runs.
+
+The server runs inside the Night Bus process. It serves:
+
+  * `/` -- JSON status of the session, from the in-memory task results
+  * `/events/<log filename>` -- the log as a stream of server-sent events
+  * `/logs/<log filename>` -- the log file as currently written to disk
+
+Live output is held in one ring buffer per log which all viewers share, so
+following a log doesn't touch the disk at all. Once a log is finished its
+buffer is dropped, and the events are read from the log file instead.
+
+There is no authentication, so by default the server only listens on the
+loopback interface.
+
+'''
+
+import gevent.event
+import gevent.server
+import gevent.socket
+
+import collections
+import itertools
+import json
+import logging
+import os
+import re
+import urllib.parse
+
+import nightbus
+
+
+DEFAULT_BUFFER_LINES = 1000
+
+DEFAULT_ADDRESS = '127.0.0.1'
+
+# Any of these would end a line of a server-sent event.
+NEWLINE_RE = re.compile('\r\n|\r|\n')
+
+
+class LogBuffer():
+    '''Holds the most recent lines of a log that is being written.'''
+    def __init__(self, name, host, filename, maxlen=DEFAULT_BUFFER_LINES):
+        self.name = name
+        self.host = host
+        self.filename = filename
+        self.lines = collections.deque(maxlen=maxlen)
+        self.count = 0
+        self.finished = False
+        self._changed = gevent.event.Event()
+
+    def _notify(self):
+        # Waiters hold a reference to the old event, which stays set.
+        changed, self._changed = self._changed, gevent.event.Event()
+        changed.set()
+
+    def append(self, line):
+        self.lines.append(line)
+        self.count += 1
+        self._notify()
+
+    def finish(self):
+        self.finished = True
+        self._notify()
+
+    def follow(self, start=0):
+        '''Yield (number, line) pairs from line `start` onwards.
+
+        Waits for more lines to be appended until the log is finished. Lines
+        which have already dropped out of the buffer are skipped.
+
+        '''
+        while True:
+            changed = self._changed
+            first = self.count - len(self.lines)
+            start = max(start, first)
+            new_lines = list(itertools.islice(self.lines, start - first, None))
+            for number, line in enumerate(new_lines, start):
+                yield number, line
+            start += len(new_lines)
+            if self.finished and start >= self.count:
+                return
+            changed.wait()
+
+
+class StatusServer(gevent.server.StreamServer):
+    '''Serves the status and logs of one session over HTTP.'''
+    def __init__(self, listener, log_directory):
+        super().__init__(listener, self.handle_request)
+        self.log_directory = log_directory
+        # The (name, host) of every log in the session, by filename.
+        self.logs = collections.OrderedDict()
+        self.live_buffers = {}
+        self.results = collections.OrderedDict()
+
+    def open_log(self, name, host, filename):
+        '''Create the buffer which holds live output for one log file.'''
+        log_buffer = LogBuffer(name, host, filename)
+        self.logs[filename] = (name, host)
+        self.live_buffers[(name, host)] = log_buffer
+        return log_buffer
+
+    def finish_log(self, name, host):
+        '''Drop the buffer of a finished log.
+
+        Anyone still following the log keeps a reference to the buffer until
+        they have read the rest of it.
+
+        '''
+        self.live_buffers.pop((name, host)).finish()
+
+    def handle_event(self, event):
+        '''Subscriber for a nightbus.events.EventStream.'''
+        if isinstance(event, nightbus.events.LineReceived):
+            self.live_buffers[(event.name, event.host)].append(event.line)
+        elif isinstance(event, nightbus.events.TaskStarted):
+            for host in event.hosts:
+                self.open_log(event.name, host,
+                              nightbus.tasks.log_filename(event.name, host))
+        elif isinstance(event, nightbus.events.HostFinished):
+            self.finish_log(event.name, event.host)
+            task_results = self.results.setdefault(
+                event.name, collections.OrderedDict())
+            task_results[event.host] = event.result
+
+    def status(self):
+        tasks = collections.OrderedDict()
+        for filename, (name, host) in self.logs.items():
+            task = tasks.setdefault(name, collections.OrderedDict())
+            running = (name, host) in self.live_buffers
+            task[host] = {
+                'status': 'running' if running else 'finished',
+                'log': filename}
+        for name, task_results in self.results.items():
+            task = tasks.setdefault(name, collections.OrderedDict())
+            for host, result in task_results.items():
+                task.setdefault(host, {}).update({
+                    'status': 'succeeded' if result.exit_code == 0 else 'failed',
+                    'exit_code': result.exit_code,
+                    'duration': result.duration,
+                    'messages': list(result.message_list),
+                    'failure_line': result.failure_line,
+                })
+        return {'session': os.path.basename(self.log_directory),
+                'tasks': tasks}
+
+    def handle_request(self, sock, address):
+        f = sock.makefile('rb')
+        try:
+            request = f.readline().decode('latin-1').split()
+            headers = {}
+            while True:
+                line = f.readline()
+                if line in (b'', b'\n', b'\r\n'):
+                    break
+                key, _, value = line.decode('latin-1').partition(':')
+                headers[key.strip().lower()] = value.strip()
+
+            if len(request) < 2 or request[0] != 'GET':
+                self.send_response(sock, 405, 'Method Not Allowed')
+                return
+
+            path = urllib.parse.unquote(urllib.parse.urlsplit(request[1]).path)
+            if path == '/':
+                body = json.dumps(self.status(), indent=2).encode('utf-8')
+                self.send_response(sock, 200, 'OK', 'application/json', body)
+            elif path.startswith('/events/'):
+                self.send_events(sock, path[len('/events/'):],
+                                 last_event_id=headers.get('last-event-id'))
+            elif path.startswith('/logs/'):
+                self.send_log_file(sock, path[len('/logs/'):])
+            else:
+                self.send_response(sock, 404, 'Not Found')
+        except OSError as e:
+            # Viewers going away is no concern of ours.
+            logging.debug("HTTP client %s: %s", address, e)
+        finally:
+            f.close()
+            sock.close()
+
+    def send_headers(self, sock, code, reason, content_type, length=None):
+        header = 'HTTP/1.1 %i %s\r\nContent-Type: %s\r\nConnection: close\r\n' % (
+            code, reason, content_type)
+        if length is not None:
+            header += 'Content-Length: %i\r\n' % length
+        sock.sendall((header + '\r\n').encode('latin-1'))
+
+    def send_response(self, sock, code, reason, content_type='text/plain',
+                      body=None):
+        if body is None:
+            body = ('%i %s\n' % (code, reason)).encode('utf-8')
+        self.send_headers(sock, code, reason, content_type, length=len(body))
+        sock.sendall(body)
+
+    def send_events(self, sock, filename, last_event_id=None):
+        if filename not in self.logs:
+            self.send_response(sock, 404, 'Not Found')
+            return
+
+        start = 0
+        if last_event_id and last_event_id.isdigit():
+            start = int(last_event_id) + 1
+
+        log_buffer = self.live_buffers.get(self.logs[filename])
+        if log_buffer is not None:
+            lines = log_buffer.follow(start)
+        else:
+            lines = self.read_log_file(filename, start)
+
+        self.send_headers(sock, 200, 'OK', 'text/event-stream')
+        for number, line in lines:
+            sock.sendall(format_event(number, line).encode('utf-8'))
+        sock.sendall(b'event: finished\ndata:\n\n')
+
+    def read_log_file(self, filename, start=0):
+        '''Yield (number, line) pairs from a finished log file.'''
+        path = os.path.join(self.log_directory, filename)
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            return
+        with f:
+            for number, line in enumerate(f):
+                if number >= start:
+                    yield number, line.rstrip(b'\n').decode('unicode-escape')
+
+    def send_log_file(self, sock, filename):
+        path = os.path.join(self.log_directory, os.path.basename(filename))
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            self.send_response(sock, 404, 'Not Found')
+            return
+        with f:
+            # Logs which are still being written may grow while we send them,
+            # so we only promise what was there when we started.
+            length = os.fstat(f.fileno()).st_size
+            self.send_headers(sock, 200, 'OK', 'text/plain; charset=utf-8',
+                              length=length)
+            send_file(sock, f, length)
+
+
+def send_file(sock, f, length):
+    '''Send the first `length` bytes of a file with the sendfile() syscall.
+
+    The socket.sendfile() method of gevent sockets copies the file through
+    Python, so we wait for the socket to be writable ourselves instead.
+
+    '''
+    offset = 0
+    while offset < length:
+        try:
+            sent = os.sendfile(sock.fileno(), f.fileno(), offset,
+                               length - offset)
+        except BlockingIOError:
+            gevent.socket.wait_write(sock.fileno())
+            continue
+        if sent == 0:
+            # The file is shorter than it was.
+            raise OSError("Log file %s was truncated while sending" % f.name)
+        offset += sent
+
+
+def format_event(number, line):
+    '''Format one line of a log as a server-sent event.'''
+    data = ''.join('data: %s\n' % part for part in NEWLINE_RE.split(line))
+    return 'id: %i\n%s\n' % (number, data)
@@ -18,9 +18,17 @@ import yaml
 
 import os
 
+from nightbus.utils import ensure_list
+
 
 class SSHConfig(dict):
-    '''Dict holding SSH configuration to access each host'''
+    '''Dict holding SSH configuration to access each host
+
+    The `labels` attribute holds the list of labels given for each host, and
+    `compress_hosts` lists the hosts with `compress_output` set. These are
+    removed from the SSH configuration itself.
+
+    '''
     def __init__(self, text):
         self.update(yaml.safe_load(text))
 
@@ -28,6 +36,14 @@ class SSHConfig(dict):
             if self[key] == None:
                 self[key] = dict()
 
+        self.labels = {host: ensure_list(config.pop('labels', None))
+                       for host, config in self.items()}
+
+        self.compress_hosts = []
+        for host, config in self.items():
+            if config.pop('compress_output', False):
+                self.compress_hosts.append(host)
+
         self._load_private_keys()
 
     def _load_private_keys(self):
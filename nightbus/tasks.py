@@ -15,13 +15,20 @@
 '''Night Bus: Simple SSH-based build automation'''
 
 import gevent
+import pssh.exceptions
 import yaml
 
+import base64
 import collections
+import copy
 import itertools
 import logging
 import os
+import re
+import shlex
+import sys
 import time
+import zlib
 
 import nightbus
 from nightbus.utils import ensure_list
@@ -29,6 +36,44 @@ from nightbus.utils import ensure_list
 
 DEFAULT_SHELL = '/bin/bash -c'
 
+# Marks the line carrying the real exit status of a task whose output was
+# piped through a compressor, as the pipe hides it from the SSH channel.
+EXIT_STATUS_MARKER = '##nightbus-exit-status '
+
+# How often the output of a task with compress_output is sent, in seconds.
+COMPRESS_FLUSH_INTERVAL = 1
+
+# Marks the line giving the exit status of a detached task, and the final size
+# of its remote log.
+DETACHED_STATUS_MARKER = '##nightbus-detached-status '
+
+# Marks each line carrying a chunk of the log of a detached task, and the
+# largest number of bytes of the log in one chunk.
+DETACHED_CHUNK_MARKER = '##nightbus-chunk '
+DETACHED_CHUNK_SIZE = 48 * 1024
+
+# Exit status reported for a detached task whose process disappeared without
+# writing its exit status, for example because it was killed or the host
+# rebooted.
+DETACHED_LOST_STATUS = 255
+
+# Marks the line giving the process ID of the shell running a task, which we
+# need in order to kill it.
+PID_MARKER = '##nightbus-pid '
+
+# How long to wait before reconnecting to follow a detached task, and how many
+# times in a row we try before giving up on it.
+RECONNECT_DELAY = 30
+RECONNECT_ATTEMPTS = 20
+
+# Errors which mean that the connection to a host was lost.
+CONNECTION_ERRORS = (pssh.exceptions.ConnectionErrorException,
+                     pssh.exceptions.SSHException, OSError)
+
+# Results with more messages than this have them written to a file, rather
+# than kept in memory for the whole session.
+DEFAULT_SPILL_THRESHOLD = 1000
+
 
 class Task():
     '''A single task that we can run on one or more hosts.'''
@@ -48,6 +93,43 @@ class Task():
         # so it's no problem for its value to be `None`.
         self.shell = attrs.get('shell', defaults.get('shell', DEFAULT_SHELL))
 
+        # None means that it depends on the host.
+        self.compress_output = attrs.get(
+            'compress_output', defaults.get('compress_output'))
+
+        self.detach = attrs.get('detach', defaults.get('detach', False))
+
+        # Labels of the hosts that this task should run on. Host names count
+        # as labels too. An empty list means all hosts.
+        self.run_on = ensure_list(attrs.get('run_on', defaults.get('run_on')))
+
+        # Patterns which indicate the task has failed, even if it continues
+        # running. They are combined into one regex so that checking each line
+        # of output is cheap.
+        fail_on = ensure_list(defaults.get('fail_on')) + \
+                  ensure_list(attrs.get('fail_on'))
+        self.fail_on = None
+        if fail_on:
+            self.fail_on = re.compile(
+                '|'.join('(?:%s)' % pattern for pattern in fail_on))
+
+    def runs_on(self, host, labels=None):
+        '''Returns True if this task should run on the given host.'''
+        if not self.run_on:
+            return True
+        return host in self.run_on or bool(set(self.run_on) & set(labels or []))
+
+    def compresses_output(self, host, compress_hosts=None):
+        '''Returns True if this task's output is compressed on the given host.
+
+        Unless the task says otherwise, output is compressed on the hosts
+        listed in `compress_hosts`.
+
+        '''
+        if self.compress_output is not None:
+            return bool(self.compress_output)
+        return host in (compress_hosts or [])
+
     def _script(self, commands, prologue=None, includes=None, parameters=None):
         '''Generate the script that executes this task.'''
         parts = []
@@ -63,20 +145,38 @@ class Task():
         return '\n'.join(parts)
 
 
+class Distribution():
+    '''A file to be copied to every host before any tasks run.'''
+    def __init__(self, attrs):
+        self.source = attrs['source']
+        self.destination = attrs.get('destination',
+                                     os.path.basename(self.source))
+        self.tree = attrs.get('tree', False)
+
+
 class TaskList(list):
-    '''Contains a user-specified list of descriptions of tasks to run.'''
+    '''Contains a user-specified list of descriptions of tasks to run.
+
+    The `distribute` attribute lists the files to be copied to the hosts
+    before the tasks run.
+
+    '''
     def __init__(self, text):
         contents = yaml.safe_load(text)
 
         if isinstance(contents, list):
             defaults = None
             entry_list = contents
+            distribute_list = []
         elif isinstance(contents, dict):
             defaults = contents.get('defaults', {})
             entry_list = contents['tasks']
+            distribute_list = contents.get('distribute', [])
         else:
             raise RuntimeError("Tasks file is invalid.")
 
+        self.distribute = [Distribution(entry) for entry in distribute_list]
+
         for entry in entry_list:
             self.extend(self._create_tasks(entry, defaults=defaults))
 
@@ -140,75 +240,597 @@ class TaskList(list):
 
 
 class TaskResult():
-    '''Results of executing a one task on one host.'''
-    def __init__(self, name, host, duration=None, exit_code=None, message_list=None):
-        self.name = name
-        self.host = host
+    '''Results of executing a one task on one host.
+
+    There can be a lot of these in a session, so they are kept small. The
+    same messages tend to appear for every host, so one copy of each can be
+    shared between results with share_messages(), and they can be moved out
+    to a file with spill_messages().
+
+    '''
+    __slots__ = ('name', 'host', 'duration', 'exit_code', 'failure_line',
+                 '_message_list', '_message_file')
+
+    def __init__(self, name, host, duration=None, exit_code=None, message_list=None,
+                 failure_line=None):
+        self.name = sys.intern(name)
+        self.host = sys.intern(host)
         self.duration = duration
         self.exit_code = exit_code
-        self.message_list = message_list
+        self.failure_line = failure_line
+        self._message_list = None
+        if message_list is not None:
+            self._message_list = list(message_list)
+        self._message_file = None
+
+    @property
+    def message_list(self):
+        if self._message_file is not None:
+            with open(self._message_file, 'rb') as f:
+                return [line.rstrip(b'\n').decode('unicode-escape')
+                        for line in f]
+        return self._message_list
 
+    def share_messages(self, shared):
+        '''Replace each message with the equal one in the `shared` dict.
 
-def run_task(client, hosts, task, log_directory, run_name=None, force=False):
-    '''Run a single task on all the specified hosts.'''
+        Messages not in `shared` are added to it.
+
+        '''
+        self._message_list = [shared.setdefault(message, message)
+                              for message in self._message_list]
+
+    def spill_messages(self, path):
+        '''Move the messages out of memory and into the given file.'''
+        with open(path, 'wb') as f:
+            for message in self._message_list:
+                f.write(message.encode('unicode-escape'))
+                f.write(b'\n')
+        self._message_file = path
+        self._message_list = None
+
+
+class ResultStore(collections.OrderedDict):
+    '''All the results of a session.
+
+    This maps the run name of each task to a dict of TaskResult objects for
+    each host, in the order the tasks ran. If `spill_directory` is set, the
+    messages of results with more than `spill_threshold` messages are moved
+    into files in that directory. The messages of other results are shared
+    through a dict owned by the store, rather than with sys.intern(), so
+    that they are freed along with the store.
+
+    '''
+    def __init__(self, spill_directory=None,
+                 spill_threshold=DEFAULT_SPILL_THRESHOLD):
+        super().__init__()
+        self.spill_directory = spill_directory
+        self.spill_threshold = spill_threshold
+        self._messages = {}
+
+    def add(self, result):
+        if (self.spill_directory and result.message_list and
+                len(result.message_list) > self.spill_threshold):
+            os.makedirs(self.spill_directory, exist_ok=True)
+            result.spill_messages(os.path.join(
+                self.spill_directory,
+                safe_filename(result.name + '.' + result.host + '.messages')))
+        elif result.message_list:
+            result.share_messages(self._messages)
+        self.setdefault(result.name, collections.OrderedDict())[result.host] = result
+
+
+def run_task(client, hosts, task, log_directory, run_name=None, force=False,
+             events=None, compress_hosts=None):
+    '''Run a single task on all the specified hosts.
+
+    Progress is reported to `events`, a nightbus.events.EventStream. If it
+    isn't given, the output is just written to log files.
+
+    Output is compressed on the hosts in `compress_hosts`, unless the task
+    sets `compress_output` itself.
+
+    '''
+    if events is None:
+        events = nightbus.events.EventStream()
+        events.subscribe(nightbus.events.LogWriter(log_directory))
 
     name = task.name
     run_name = run_name or name
     logging.info("%s: Starting task run", run_name)
+    events.emit(nightbus.events.TaskStarted(run_name, list(hosts)))
 
     start_time = time.time()
 
     # Run the commands asynchronously on all hosts.
     cmd = 'task_name=%s\n' % name
+    if task.fail_on:
+        # $$ would give the outermost shell, which isn't the one running the
+        # task when compress_output or detach wrap it in a subshell.
+        cmd = 'echo "%s$(exec sh -c \'echo $PPID\')"\n' % PID_MARKER + cmd
     if force:
         cmd += 'force=yes\n'
     cmd += task.script
 
+    compressed = {host: task.compresses_output(host, compress_hosts)
+                  for host in hosts}
+
     shell = task.shell
-    output = client.run_command(cmd, shell=shell, stop_on_errors=True)
+    remote_directory = None
+    launches = []
+    failed_launches = set()
+    if task.detach:
+        remote_directory = detached_directory(log_directory, run_name)
+        task_client = client_for_hosts(client, hosts)
+        output = task_client.run_command(
+            detached_launch_command(cmd, shell, remote_directory),
+            shell=shell, stop_on_errors=True)
+        task_client.join(output)
+        for host in hosts:
+            if output[host].exit_code != 0:
+                logging.warning("%s: Failed to start detached task on %s, "
+                                "exit code %s", run_name, host,
+                                output[host].exit_code)
+                failed_launches.add(host)
+    else:
+        # The same command is run on every host, so hosts with compressed
+        # output need to be started separately.
+        output = {}
+        for compress in [False, True]:
+            group = [host for host in hosts if compressed[host] == compress]
+            if not group:
+                continue
+            group_client = client_for_hosts(client, group)
+            group_output = group_client.run_command(
+                compressed_command(cmd) if compress else cmd, shell=shell,
+                stop_on_errors=True)
+            output.update(group_output)
+            launches.append((group_client, group_output))
 
     # ParallelSSH doesn't give us a way to run a callback when the host
-    # produces output or the command completes. In order to stream the
-    # output into separate log files, we run a Greenlet to monitor each
-    # host.
+    # produces output or the command completes. In order to turn the output
+    # into events, we run a Greenlet to monitor each host.
     def watch_output(output, host):
-        log_filename = safe_filename(run_name + '.' + host + '.log')
-        log = os.path.join(log_directory, log_filename)
+        if task.detach and host not in failed_launches:
+            lines = follow_detached(client, host, task, remote_directory,
+                                    compress=compressed[host])
+        elif task.detach:
+            # Any errors from starting the task are all there is to show.
+            lines = output[host].stdout
+        else:
+            lines = output[host].stdout
+            if compressed[host]:
+                lines = decompress_output(lines)
+
+        LineReceived = nightbus.events.LineReceived
+        MessageReceived = nightbus.events.MessageReceived
 
         messages = []
-        with open(log, 'wb') as f:
-            for line in output[host].stdout:
-                f.write(line.encode('unicode-escape'))
-                f.write(b'\n')
-                if line.startswith('##nightbus '):
-                    messages.append(line[len('##nightbus '):])
+        exit_code = None
+        pid = None
+        failure_line = None
+        killer = None
+        if compressed[host] or task.detach:
+            lines = split_exit_status(lines)
+        else:
+            lines = ((line, None) for line in lines)
+        for line, status in lines:
+            if line is None:
+                exit_code = status
+                continue
+            if task.fail_on:
+                if pid is None and line.startswith(PID_MARKER):
+                    pid = int(line[len(PID_MARKER):])
+                    continue
+                if failure_line is None and task.fail_on.search(line):
+                    logging.warning("%s: Stopping task on %s, output "
+                                    "matched fail_on: %s", run_name, host,
+                                    line)
+                    failure_line = line
+                    killer = gevent.spawn(kill_task, client, host, pid)
+            events.emit(LineReceived(run_name, host, line))
+            if line.startswith('##nightbus '):
+                message = line[len('##nightbus '):]
+                messages.append(message)
+                events.emit(MessageReceived(run_name, host, message))
+
+        if killer:
+            killer.join()
 
         duration = time.time() - start_time
-        exit_code = output[host].exit_code
-        return nightbus.tasks.TaskResult(
-            run_name, host, duration=duration, exit_code=exit_code, message_list=messages)
-
-    watchers = [gevent.spawn(watch_output, output, host) for host in hosts]
+        if exit_code is None and (not task.detach or host in failed_launches):
+            exit_code = output[host].exit_code
+        if failure_line is not None and exit_code == 0:
+            exit_code = 1
+        result = nightbus.tasks.TaskResult(
+            run_name, host, duration=duration, exit_code=exit_code, message_list=messages,
+            failure_line=failure_line)
+        events.emit(nightbus.events.HostFinished(run_name, host, result))
+        return result
+
+    watchers = []
+    for host in hosts:
+        watcher = gevent.spawn(watch_output, output, host)
+        # This identifies the watcher in the output of nightbus.profiling.
+        watcher.name = '%s:%s' % (run_name, host)
+        watchers.append(watcher)
 
     gevent.joinall(watchers, raise_error=True)
 
-    logging.info("%s: Started all jobs, waiting for them to finish", run_name)
-    client.join(output)
+    if launches:
+        logging.info("%s: Started all jobs, waiting for them to finish", run_name)
+        for group_client, group_output in launches:
+            group_client.join(group_output)
     logging.info("%s: All jobs finished", run_name)
 
     results = collections.OrderedDict()
     for result in sorted((watcher.value for watcher in watchers),
                          key=lambda result: result.host):
         results[result.host] = result
+    events.emit(nightbus.events.TaskFinished(run_name, results))
     return results
 
 
+def compressed_command(cmd):
+    '''Wrap a command so that its output is compressed on the remote side.
+
+    The command's output goes to a temporary file. Every
+    COMPRESS_FLUSH_INTERVAL seconds, whatever was added to the file since
+    last time is sent as a separate gzip member, base64 encoded so it
+    survives being read as lines of text. A single gzip stream would hold
+    back output until it had filled a whole block, which could take hours
+    for a quiet task.
+
+    The exit status seen by SSH would be that of the wrapper, so the real one
+    is sent uncompressed after all of the output.
+
+    Where `fallocate` can punch holes in the temporary file, the space used
+    by output that has been sent is freed as we go. The file is removed when
+    the wrapper exits. If the connection is lost or the wrapper is killed,
+    the task is killed too, as it would be if it was writing to the
+    connection itself.
+
+    '''
+    return '\n'.join([
+        'nightbus_output=$(mktemp)',
+        '{ (',
+        cmd,
+        '); echo $? > "$nightbus_output.status"; } >> "$nightbus_output" &',
+        'nightbus_pid=$!',
+        'trap \'rm -f "$nightbus_output" "$nightbus_output.status"\' EXIT',
+        'nightbus_abort() {',
+        kill_command('$nightbus_pid'),
+        'exit 1',
+        '}',
+        'trap nightbus_abort HUP TERM PIPE',
+        'nightbus_offset=0',
+        'while true; do',
+        '    nightbus_done=no',
+        '    [ -e "$nightbus_output.status" ] && nightbus_done=yes',
+        '    nightbus_size=$(($(wc -c < "$nightbus_output")))',
+        '    if [ $nightbus_size -gt $nightbus_offset ]; then',
+        '        tail -c +$((nightbus_offset + 1)) "$nightbus_output" | '
+        'head -c $((nightbus_size - nightbus_offset)) | gzip -c | base64 || '
+        'nightbus_abort',
+        '        nightbus_offset=$nightbus_size',
+        '        fallocate -p -o 0 -l $nightbus_offset "$nightbus_output" '
+        '2> /dev/null',
+        '    fi',
+        '    [ $nightbus_done = yes ] && break',
+        '    sleep %i' % COMPRESS_FLUSH_INTERVAL,
+        'done',
+        'echo "%s$(cat "$nightbus_output.status")"' % EXIT_STATUS_MARKER,
+    ])
+
+
+def decompress_output(lines):
+    '''Decode output lines produced by a command from compressed_command().
+
+    Decompression is incremental, so lines are yielded as soon as each gzip
+    member arrives. The exit status line is passed through as it is, after
+    any incomplete last line of output.
+
+    '''
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    pending = b''
+    for encoded_line in lines:
+        if encoded_line.startswith(EXIT_STATUS_MARKER):
+            if pending:
+                yield pending.decode('utf-8', errors='replace')
+                pending = b''
+            yield encoded_line
+            continue
+
+        data = base64.b64decode(encoded_line)
+        while data:
+            pending += decompressor.decompress(data)
+            data = decompressor.unused_data
+            if decompressor.eof:
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        *complete, pending = pending.split(b'\n')
+        for line in complete:
+            yield line.decode('utf-8', errors='replace')
+    if pending:
+        yield pending.decode('utf-8', errors='replace')
+
+
+def split_exit_status(lines):
+    '''Separate the exit status from the output of a wrapped command.
+
+    Yields (line, None) for each line of output, then (None, exit_code) if
+    the last line gives the exit status. A task could print a line that looks
+    like an exit status itself, so only the last line counts.
+
+    '''
+    held_line = None
+    for line in lines:
+        if held_line is not None:
+            yield held_line, None
+            held_line = None
+        if line.startswith(EXIT_STATUS_MARKER):
+            held_line = line
+        else:
+            yield line, None
+    if held_line is not None:
+        try:
+            yield None, int(held_line[len(EXIT_STATUS_MARKER):])
+        except ValueError:
+            yield held_line, None
+
+
+def client_for_hosts(client, hosts):
+    '''Return a copy of `client` which only runs commands on `hosts`.
+
+    The copy shares its connections with the original.
+
+    '''
+    host_client = copy.copy(client)
+    host_client.hosts = list(hosts)
+    return host_client
+
+
+def forget_connection(client, host):
+    '''Make `client` open a new connection next time it talks to `host`.'''
+    getattr(client, 'host_clients', {}).pop(host, None)
+
+
+def kill_command(pid):
+    '''Kill a process and all of its descendents.
+
+    The processes are all stopped before any are killed, so that the shell
+    running a task doesn't carry on to its next command when we kill the
+    current one. The `pid` can be a number, or a shell expression such as
+    '$pid'.
+
+    '''
+    return '\n'.join([
+        'process_tree() {',
+        '    echo $1',
+        '    for child in $(ps -e -o pid= -o ppid= | '
+        'awk -v parent=$1 \'$2 == parent { print $1 }\'); do',
+        '        process_tree $child',
+        '    done',
+        '}',
+        'pids=$(process_tree %s)' % pid,
+        'kill -STOP $pids',
+        'kill -TERM $pids',
+        'kill -CONT $pids',
+    ])
+
+
+def kill_task(client, host, pid):
+    '''Kill a running task on one host.'''
+    if pid is None:
+        logging.warning("%s: Can't stop task, its process ID is unknown", host)
+        return
+    try:
+        host_client = client_for_hosts(client, [host])
+        host_client.join(host_client.run_command(
+            kill_command(pid), stop_on_errors=True))
+    except Exception as e:
+        logging.warning("%s: Couldn't stop task: %s", host, e)
+
+
+def detached_directory(log_directory, run_name):
+    '''Directory on the remote host holding the state of a detached task.
+
+    This is relative to the home directory, where commands run.
+
+    '''
+    session_name = os.path.basename(os.path.normpath(log_directory))
+    return os.path.join('.nightbus', session_name, safe_filename(run_name))
+
+
+def detached_launch_command(cmd, shell, remote_directory):
+    '''Start a task in the background on the remote host, and return.
+
+    The task's output goes to a log file and its exit status is written to a
+    status file once it finishes. The process ID of the subshell waiting for
+    it is written to a pid file, so detached_follow_command() can tell if it
+    disappears. The task ignores SIGHUP, so it survives the SSH connection
+    being dropped. The command exits with a non-zero status if the task
+    couldn't be started.
+
+    '''
+    directory = shlex.quote(remote_directory)
+    run_script = '%s %s' % (shell or '/bin/sh -c',
+                            shlex.quote('. %s/script' % directory))
+    return '\n'.join([
+        'set -e',
+        'mkdir -p %s' % directory,
+        'rm -f %s/status' % directory,
+        'cat > %s/script <<\'NIGHTBUS_DETACHED_SCRIPT\'' % directory,
+        cmd,
+        'NIGHTBUS_DETACHED_SCRIPT',
+        ': > %s/log' % directory,
+        '( set +e; trap "" HUP; %s >> %s/log 2> %s/stderr < /dev/null; '
+        'echo $? > %s/status.new; mv %s/status.new %s/status ) '
+        '> /dev/null 2>&1 < /dev/null &' % (
+            run_script, directory, directory, directory, directory, directory),
+        'echo $! > %s/pid' % directory,
+    ])
+
+
+def detached_follow_command(remote_directory, offset, compress=False):
+    '''Output the log of a detached task from `offset` until it finishes.
+
+    The log is sent in chunks, each base64 encoded and labelled with its
+    offset and size, so that the output is exactly the bytes of the log, and
+    a chunk cut short by a dropped connection can be detected. The chunks can
+    also be compressed. The last line gives the exit status and the final
+    size of the log. If the task's process has gone and there is still no
+    status file, a note is added to the log and DETACHED_LOST_STATUS is
+    given as the exit status.
+
+    '''
+    directory = shlex.quote(remote_directory)
+    encode = 'gzip -c | base64' if compress else 'base64'
+    return '\n'.join([
+        'nightbus_offset=%i' % offset,
+        'while true; do',
+        '    nightbus_done=no',
+        '    [ -e %s/status ] && nightbus_done=yes' % directory,
+        # The status file is checked again after checking the process, in
+        # case the task finished in between.
+        '    if [ $nightbus_done = no ] && '
+        '! kill -0 "$(cat %s/pid)" 2> /dev/null && [ ! -e %s/status ]; then' % (
+            directory, directory),
+        '        echo "Night Bus: the task ended without writing its exit '
+        'status" >> %s/log' % directory,
+        '        echo %i > %s/status' % (DETACHED_LOST_STATUS, directory),
+        '        nightbus_done=yes',
+        '    fi',
+        '    nightbus_size=$(($(wc -c < %s/log)))' % directory,
+        '    while [ $nightbus_offset -lt $nightbus_size ]; do',
+        '        nightbus_count=$((nightbus_size - nightbus_offset))',
+        '        [ $nightbus_count -gt %i ] && nightbus_count=%i' % (
+            DETACHED_CHUNK_SIZE, DETACHED_CHUNK_SIZE),
+        '        echo "%s$nightbus_offset $nightbus_count $('
+        'tail -c +$((nightbus_offset + 1)) %s/log | '
+        'head -c $nightbus_count | %s | tr -d \'\\n\')"' % (
+            DETACHED_CHUNK_MARKER, directory, encode),
+        '        nightbus_offset=$((nightbus_offset + nightbus_count))',
+        '    done',
+        '    [ $nightbus_done = yes ] && break',
+        '    sleep 1',
+        'done',
+        'echo "%s$(cat %s/status) $nightbus_offset"' % (
+            DETACHED_STATUS_MARKER, directory),
+    ])
+
+
+def decode_chunk(line, compressed=False):
+    '''Return (offset, data) from a line output by detached_follow_command().
+
+    Raises ValueError if the line is incomplete.
+
+    '''
+    fields = line[len(DETACHED_CHUNK_MARKER):].split(' ')
+    if len(fields) != 3:
+        raise ValueError("Expected 3 fields in chunk, got %i" % len(fields))
+    offset, size = int(fields[0]), int(fields[1])
+    data = base64.b64decode(fields[2], validate=True)
+    if compressed:
+        try:
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        except zlib.error as e:
+            raise ValueError(str(e))
+    if len(data) != size:
+        raise ValueError("Expected %i bytes in chunk, got %i" %
+                         (size, len(data)))
+    return offset, data
+
+
+def follow_detached(client, host, task, remote_directory, compress=False):
+    '''Yield the output lines of a detached task running on `host`.
+
+    If the connection drops we reconnect and carry on from the last chunk of
+    the log we received, so no output is duplicated or lost. The final line
+    yielded gives the exit status of the task, in the same format as
+    compressed_command() uses. Nothing is yielded for the exit status if we
+    can't reconnect.
+
+    '''
+    offset = 0
+    pending = b''
+    failures = 0
+    while True:
+        cmd = detached_follow_command(remote_directory, offset,
+                                      compress=compress)
+
+        status = size = None
+        start_offset = offset
+        try:
+            output = client_for_hosts(client, [host]).run_command(
+                cmd, shell=task.shell, stop_on_errors=True)
+            for line in output[host].stdout:
+                if line.startswith(DETACHED_STATUS_MARKER):
+                    status, size = [int(field) for field in
+                                    line[len(DETACHED_STATUS_MARKER):].split()]
+                elif line.startswith(DETACHED_CHUNK_MARKER):
+                    try:
+                        chunk_offset, data = decode_chunk(
+                            line, compressed=compress)
+                    except ValueError as e:
+                        logging.warning("%s: Received an incomplete chunk of "
+                                        "output from detached task: %s",
+                                        host, e)
+                        break
+                    if chunk_offset != offset:
+                        raise RuntimeError(
+                            "%s: Expected output of detached task from byte "
+                            "%i, got byte %i" % (host, offset, chunk_offset))
+                    offset += len(data)
+                    *complete, pending = (pending + data).split(b'\n')
+                    for complete_line in complete:
+                        yield complete_line.decode('utf-8', errors='replace')
+        except CONNECTION_ERRORS as e:
+            logging.warning("%s: Lost connection following detached task: %s",
+                            host, e)
+
+        if status is not None:
+            if offset != size:
+                raise RuntimeError(
+                    "%s: Received %i bytes of output from detached task, but "
+                    "its log is %i bytes" % (host, offset, size))
+            break
+        if offset > start_offset:
+            failures = 0
+        failures += 1
+        if failures > RECONNECT_ATTEMPTS:
+            logging.error("%s: Giving up on detached task after %i attempts "
+                          "to reconnect.", host, RECONNECT_ATTEMPTS)
+            return
+        logging.info("%s: Reconnecting in %i seconds to resume from byte %i",
+                     host, RECONNECT_DELAY, offset)
+        gevent.sleep(RECONNECT_DELAY)
+        forget_connection(client, host)
+
+    if pending:
+        yield pending.decode('utf-8', errors='replace')
+
+    try:
+        host_client = client_for_hosts(client, [host])
+        host_client.join(host_client.run_command(
+            'rm -rf %s' % shlex.quote(remote_directory), stop_on_errors=True))
+    except CONNECTION_ERRORS as e:
+        logging.warning("%s: Couldn't remove %s: %s", host, remote_directory, e)
+
+    yield '%s%i' % (EXIT_STATUS_MARKER, status)
+
+
 def safe_filename(filename):
     # If you want to escape more characters, switch to using re.sub()
     return filename.replace('/', '_')
 
 
-def run_all_tasks(client, hosts, tasks, log_directory, force=False):
+def log_filename(run_name, host):
+    '''Name of the log file for one run of a task on one host.'''
+    return safe_filename(run_name + '.' + host + '.log')
+
+
+def run_all_tasks(client, hosts, tasks, log_directory, force=False,
+                  host_labels=None, events=None, compress_hosts=None):
     '''Loop through each task sequentially.
 
     We only want to run one task on a host at a time, as we assume it'll
@@ -216,39 +838,69 @@ def run_all_tasks(client, hosts, tasks, log_directory, force=False):
     could move onto the next task before slow hosts have finished with the
     previous one it might be nice.
 
+    Each task only runs on the hosts selected by its `run_on` labels, which
+    are matched against `host_labels`, a dict of labels for each host.
+    Output is compressed on the hosts in `compress_hosts`, unless a task sets
+    `compress_output` itself.
+
+    Progress is reported to `events`, a nightbus.events.EventStream, as well
+    as to the log files.
+
     '''
-    all_results = collections.OrderedDict()
+    host_labels = host_labels or {}
+    events = events or nightbus.events.EventStream()
+    log_writer = nightbus.events.LogWriter(log_directory)
+    events.subscribe(log_writer)
+
+    all_results = ResultStore(
+        spill_directory=os.path.join(log_directory, 'messages'))
     number = 1
     working_hosts = list(hosts)
-    for task in tasks:
-        name = '%i.%s' % (number, task.name)
-
-        try:
-            result_dict = run_task(
-                client, working_hosts, task, log_directory=log_directory,
-                run_name=name, force=force)
-            all_results[name] = result_dict
-
-            failed_hosts = [t.host for t in result_dict.values()
-                            if t.exit_code != 0]
-
-            if failed_hosts:
-                msg = ("Task %s failed on: %s. No more tasks will run on "
-                       "failed hosts." % (name, ', '.join(failed_hosts)))
-                logging.warning(msg)
-                for host in failed_hosts:
-                    working_hosts.remove(host)
-                if len(working_hosts) == 0:
-                    logging.warning("All hosts have failed, exiting.")
-                    break
+    try:
+        for task in tasks:
+            name = '%i.%s' % (number, task.name)
+
+            task_hosts = [host for host in working_hosts
+                          if task.runs_on(host, host_labels.get(host))]
+            if not task_hosts:
+                logging.info("%s: No selected hosts match run_on, skipping",
+                             name)
+                number += 1
+                continue
+
+            try:
+                result_dict = run_task(
+                    client, task_hosts, task, log_directory=log_directory,
+                    run_name=name, force=force, events=events,
+                    compress_hosts=compress_hosts)
+                for result in result_dict.values():
+                    all_results.add(result)
+
+                failed_hosts = [t.host for t in result_dict.values()
+                                if t.exit_code != 0]
+
+                if failed_hosts:
+                    msg = ("Task %s failed on: %s. No more tasks will run on "
+                           "failed hosts." % (name, ', '.join(failed_hosts)))
+                    logging.warning(msg)
+                    for host in failed_hosts:
+                        working_hosts.remove(host)
+                    if len(working_hosts) == 0:
+                        logging.warning("All hosts have failed, exiting.")
+                        break
 
-            number += 1
-        except KeyboardInterrupt:
-            # If any tasks finished then we should write a report, even if later
-            # tasks got interrupted. Thus we must KeyboardInterrupt here so
-            # that previous results are returned.
-            logging.info("Received KeyboardInterrupt")
-            break
+                number += 1
+            except KeyboardInterrupt:
+                # If any tasks finished then we should write a report, even if
+                # later tasks got interrupted. Thus we must KeyboardInterrupt
+                # here so that previous results are returned.
+                logging.info("Received KeyboardInterrupt")
+                break
+    finally:
+        # Subscribers close their files when the session finishes, so this
+        # happens even if a task raised an exception.
+        events.emit(nightbus.events.SessionFinished(all_results))
+        events.unsubscribe(log_writer)
     return all_results
 
 
@@ -275,51 +927,74 @@ def filter_messages_for_task(task_results):
         return message_list, {first_host: message_list}
     else:
         other_hosts = host_list[1:]
-        unprocessed_messages = {host: collections.deque(result.message_list)
-                                for host, result in task_results.items()}
+        message_lists = {host: result.message_list
+                         for host, result in task_results.items()}
+        # Index of the first unprocessed message for each host.
+        positions = {host: 0 for host in other_hosts}
 
         global_messages = []
         host_messages = {host:[] for host in host_list}
 
         # This algorithm isn't smart and will not scale well to lots of
-        # messages.
+        # messages, but at least list.index() means the searching is done
+        # in C, and we don't copy the message lists.
 
-        while unprocessed_messages[first_host]:
-            # Take the first message, and search for it in all the other
-            # message streams.
-            message = unprocessed_messages[first_host].popleft()
-            is_global = True
+        for message in message_lists[first_host]:
+            # Search for each message in all the other message streams.
+            found_positions = {}
             for host in other_hosts:
-                for host_message in unprocessed_messages[host]:
-                    if message == host_message:
-                        break
-                else:
-                    is_global = False
-                if not is_global:
+                try:
+                    found_positions[host] = message_lists[host].index(
+                        message, positions[host])
+                except ValueError:
                     break
 
-            if is_global:
+            if len(found_positions) == len(other_hosts):
                 global_messages.append(message)
-                # Now remove this message from the other hosts' message lists,
-                # plus anything we find before that (which we take to be host
-                # specific messages).
+                # Now skip past this message in the other hosts' message
+                # lists, plus anything we find before that (which we take to
+                # be host specific messages).
                 for host in other_hosts:
-                    while len(unprocessed_messages[host]) > 0:
-                        host_message = unprocessed_messages[host].popleft()
-                        if host_message == message:
-                            break
-                        host_messages[host].append(host_message)
+                    host_messages[host] += message_lists[host][
+                        positions[host]:found_positions[host]]
+                    positions[host] = found_positions[host] + 1
             else:
                 host_messages[first_host].append(message)
 
         for host in other_hosts:
-            host_messages[host] += unprocessed_messages[host]
+            host_messages[host] += message_lists[host][positions[host]:]
 
         return global_messages, host_messages
 
 
+def write_task_report(f, task_name, task_results):
+    '''Write the section of the report for one task.'''
+    f.write("%s:\n" % task_name)
+
+    global_messages, host_messages = filter_messages_for_task(task_results)
+
+    for message in global_messages:
+        f.write("  %s\n" % message)
+
+    for host, result in task_results.items():
+        status = "succeeded" if result.exit_code == 0 else "failed"
+        duration = duration_as_string(result.duration)
+        f.write("  - %s: %s in %s\n" % (host, status, duration))
+        if result.failure_line is not None:
+            f.write("    Stopped after output matched: %s\n" %
+                    result.failure_line)
+        for message in host_messages[host]:
+            f.write("    %s\n" % message)
+
+
 def write_report(f, all_results):
-    '''Write a report containing task results and durations.'''
+    '''Write a report containing task results and durations.
+
+    The report is written one task at a time, so that only the messages of
+    the current task need to be in memory. See also
+    nightbus.events.ReportWriter, which writes each task as it finishes.
+
+    '''
     first_line = True
     for task_name, task_results in all_results.items():
         if first_line:
@@ -327,16 +1002,4 @@ def write_report(f, all_results):
         else:
             f.write("\n")
 
-        f.write("%s:\n" % task_name)
-
-        global_messages, host_messages = filter_messages_for_task(task_results)
-
-        for message in global_messages:
-            f.write("  %s\n" % message)
-
-        for host, result in task_results.items():
-            status = "succeeded" if result.exit_code == 0 else "failed"
-            duration = duration_as_string(result.duration)
-            f.write("  - %s: %s in %s\n" % (host, status, duration))
-            for message in host_messages[host]:
-                f.write("    %s\n" % message)
+        write_task_report(f, task_name, task_results)
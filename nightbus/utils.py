@@ -16,6 +16,7 @@
 '''Utility functions.'''
 
 
+import hashlib
 import itertools
 
 
@@ -33,3 +34,12 @@ def ensure_list(string_or_list_or_none, separator=None):
             return string_or_list_or_none
     else:
         return []
+
+
+def file_digest(path):
+    '''Return the SHA-256 digest of a file, as a hex string.'''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
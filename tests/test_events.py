@@ -0,0 +1,102 @@
+# Copyright 2017 Codethink Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Unit tests for nightbus.events module'''
+
+import pytest
+
+import collections
+
+import nightbus
+from nightbus.events import (TaskStarted, LineReceived, HostFinished,
+                             TaskFinished, SessionFinished)
+
+
+def example_events():
+    result = nightbus.tasks.TaskResult('1.task', 'host', duration=1,
+                                       exit_code=0, message_list=['hello'])
+    return [
+        TaskStarted('1.task', ['host']),
+        LineReceived('1.task', 'host', 'first line'),
+        LineReceived('1.task', 'host', '##nightbus hello'),
+        HostFinished('1.task', 'host', result),
+        TaskFinished('1.task', collections.OrderedDict([('host', result)])),
+        SessionFinished(None),
+    ]
+
+
+def test_event_stream():
+    '''Each subscriber receives every event in order.'''
+    events = nightbus.events.EventStream()
+    received_1 = []
+    received_2 = []
+    events.subscribe(received_1.append)
+    events.subscribe(received_2.append)
+
+    sent = example_events()
+    for event in sent:
+        events.emit(event)
+
+    assert received_1 == received_2 == sent
+
+
+def test_log_and_report_writers(tmpdir):
+    '''Log files and the report are written from events.'''
+    events = nightbus.events.EventStream()
+    events.subscribe(nightbus.events.LogWriter(str(tmpdir)))
+    events.subscribe(nightbus.events.ReportWriter(str(tmpdir.join('report.txt'))))
+
+    for event in example_events():
+        events.emit(event)
+
+    assert tmpdir.join('1.task.host.log').read() == \
+        'first line\n##nightbus hello\n'
+    assert tmpdir.join('report.txt').read() == \
+        '1.task:\n  hello\n  - host: succeeded in 0:00:01\n    hello\n'
+
+
+def test_status_server_events(tmpdir):
+    '''The HTTP server gets its status and live logs from events.'''
+    server = nightbus.server.StatusServer(('127.0.0.1', 0), str(tmpdir))
+    for event in example_events():
+        server.handle_event(event)
+
+    assert server.logs == {'1.task.host.log': ('1.task', 'host')}
+    assert server.live_buffers == {}
+    assert server.status()['tasks']['1.task']['host']['status'] == 'succeeded'
+
+
+def test_session_finished_after_error(tmpdir):
+    '''The session is finished, and the logs closed, if a task fails to run.'''
+    class BrokenClient():
+        hosts = []
+
+        def run_command(self, *args, **kwargs):
+            raise RuntimeError("Broken")
+
+    tasks = nightbus.tasks.TaskList('''
+    - name: task
+      commands: echo "hello"
+    ''')
+
+    events = nightbus.events.EventStream()
+    received = []
+    events.subscribe(received.append)
+
+    with pytest.raises(RuntimeError):
+        nightbus.tasks.run_all_tasks(BrokenClient(), ['host'], tasks,
+                                     str(tmpdir), events=events)
+
+    assert [type(event) for event in received] == [TaskStarted, SessionFinished]
+    assert events.subscribers == [received.append]
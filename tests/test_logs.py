@@ -0,0 +1,118 @@
+# Copyright 2017 Codethink Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Unit tests for nightbus.logs module'''
+
+import collections
+import gzip
+import os
+import time
+
+import nightbus
+from nightbus.tasks import TaskResult
+
+
+def make_session(log_directory, session_name, exit_codes):
+    '''Create a session directory with a log for each (run, host) pair.'''
+    log_directory.mkdir(session_name)
+    all_results = collections.OrderedDict()
+    for (run_name, host), exit_code in exit_codes.items():
+        log_directory.join(session_name, '%s.%s.log' % (run_name, host)).write(
+            'Output of %s\n' % run_name)
+        task_results = all_results.setdefault(run_name, collections.OrderedDict())
+        task_results[host] = TaskResult(run_name, host, duration=1,
+                                        exit_code=exit_code, message_list=[])
+    nightbus.logs.update_index(str(log_directory), session_name, all_results)
+
+
+def test_index(tmpdir):
+    '''The index records each result, and can be searched.'''
+    make_session(tmpdir, '2017.01.01-00.00.00', {('1.build', 'host1'): 1,
+                                                 ('1.build', 'host2'): 0})
+    make_session(tmpdir, '2017.01.02-00.00.00', {('1.build', 'host1'): 0})
+
+    entries = nightbus.logs.read_index(str(tmpdir))
+    assert len(entries) == 3
+    assert entries[0]['task'] == 'build'
+    assert entries[0]['log'] == '1.build.host1.log'
+    assert entries[0]['log_size'] == len('Output of 1.build\n')
+
+    found = nightbus.logs.find_results(entries, tasks=['build'],
+                                       hosts=['host1'])
+    assert [entry['session'] for entry in found] == [
+        '2017.01.02-00.00.00', '2017.01.01-00.00.00']
+
+    found = nightbus.logs.find_results(entries, status='failed')
+    assert [(entry['session'], entry['host']) for entry in found] == [
+        ('2017.01.01-00.00.00', 'host1')]
+
+
+def test_prune(tmpdir):
+    '''Old sessions are removed or compressed, and duplicates hardlinked.'''
+    make_session(tmpdir, '2017.01.01-00.00.00', {('1.build', 'host1'): 0})
+    make_session(tmpdir, '2017.01.20-00.00.00', {('1.build', 'host1'): 0})
+    make_session(tmpdir, '2017.01.30-00.00.00', {('1.build', 'host1'): 0})
+    make_session(tmpdir, '2017.01.31-00.00.00', {('1.build', 'host1'): 0})
+
+    # Sessions which crashed, or are older than the index, aren't in it.
+    tmpdir.mkdir('2016.12.25-00.00.00').join('1.build.host1.log').write(
+        'Crashed\n')
+    tmpdir.mkdir('2017.01.21-00.00.00').join('1.build.host1.log').write(
+        'Crashed\n')
+
+    # A session which is still running isn't in the index yet.
+    running = tmpdir.mkdir('2017.01.03-00.00.00')
+    running.join('1.build.host1.log').write('Still running\n')
+    session_lock = nightbus.logs.lock_session(str(running))
+
+    now = time.mktime(time.strptime('2017.02.01', '%Y.%m.%d'))
+    nightbus.logs.prune(str(tmpdir), keep_days=30, compress_days=7, now=now)
+    session_lock.close()
+
+    assert not tmpdir.join('2017.01.01-00.00.00').exists()
+    assert not tmpdir.join('2016.12.25-00.00.00').exists()
+    assert tmpdir.join('2017.01.21-00.00.00', '1.build.host1.log.gz').exists()
+    assert running.join('1.build.host1.log').read() == 'Still running\n'
+
+    compressed_log = tmpdir.join('2017.01.20-00.00.00', '1.build.host1.log.gz')
+    with gzip.open(str(compressed_log), 'rt') as f:
+        assert f.read() == 'Output of 1.build\n'
+
+    assert os.path.samefile(
+        str(tmpdir.join('2017.01.30-00.00.00', '1.build.host1.log')),
+        str(tmpdir.join('2017.01.31-00.00.00', '1.build.host1.log')))
+
+    entries = nightbus.logs.read_index(str(tmpdir))
+    assert [(entry['session'], entry['log']) for entry in entries] == [
+        ('2017.01.20-00.00.00', '1.build.host1.log.gz'),
+        ('2017.01.30-00.00.00', '1.build.host1.log'),
+        ('2017.01.31-00.00.00', '1.build.host1.log'),
+    ]
+
+
+def test_diff(tmpdir):
+    '''Matching lines which differ between two sessions are reported.'''
+    make_session(tmpdir, '2017.01.01-00.00.00', {('1.test', 'host1'): 0})
+    make_session(tmpdir, '2017.01.02-00.00.00', {('1.test', 'host1'): 0})
+    tmpdir.join('2017.01.01-00.00.00', '1.test.host1.log').write(
+        'PASS: one\nFAIL: two\nFAIL: three')
+    tmpdir.join('2017.01.02-00.00.00', '1.test.host1.log').write(
+        'FAIL: one\nPASS: two\nFAIL: three\nFAIL: four\n')
+
+    results = nightbus.logs.diff_sessions(
+        str(tmpdir), '2017.01.01-00.00.00', '2017.01.02-00.00.00',
+        patterns=['^FAIL:'])
+
+    assert results == [('test', 'host1', ['FAIL: one', 'FAIL: four'],
+                        ['FAIL: two'])]
@@ -17,6 +17,7 @@
 import pytest
 
 import io
+import json
 import os
 import sys
 
@@ -140,3 +141,183 @@ def test_messages(example_hosts, tmpdir):
     assert report_lines[3].startswith('    This message is different per host:')
     assert report_lines[4].startswith('  - 127.0.0.2: succeeded in')
     assert report_lines[5].startswith('    This message is different per host:')
+
+
+def test_compress_output(example_hosts, tmpdir):
+    '''Compressed output is logged as normal and keeps the exit code.'''
+
+    TASKS = '''
+    tasks:
+    - name: compressed
+      compress_output: yes
+      commands: |
+        echo "hello"
+        echo "##nightbus A message"
+        exit 3
+    '''
+
+    tasks = nightbus.tasks.TaskList(TASKS)
+
+    client = pssh.ParallelSSHClient(example_hosts, host_config=example_hosts)
+    results = nightbus.tasks.run_all_tasks(
+        client, example_hosts, tasks, log_directory=str(tmpdir))
+
+    for host in example_hosts:
+        result = results['1.compressed'][host]
+        assert result.exit_code == 3
+        assert result.message_list == ['A message']
+
+        log = tmpdir.join('1.compressed.%s.log' % host).read()
+        assert log == 'hello\n##nightbus A message\n'
+
+
+def test_detach(example_hosts, tmpdir):
+    '''Detached tasks are followed until they finish.'''
+
+    TASKS = '''
+    tasks:
+    - name: detached
+      detach: yes
+      commands: |
+        echo "hello"
+        sleep 2
+        echo "##nightbus A message"
+        exit 3
+    '''
+
+    tasks = nightbus.tasks.TaskList(TASKS)
+
+    client = pssh.ParallelSSHClient(example_hosts, host_config=example_hosts)
+    results = nightbus.tasks.run_all_tasks(
+        client, example_hosts, tasks, log_directory=str(tmpdir))
+
+    for host in example_hosts:
+        result = results['1.detached'][host]
+        assert result.exit_code == 3
+        assert result.message_list == ['A message']
+
+        log = tmpdir.join('1.detached.%s.log' % host).read()
+        assert log == 'hello\n##nightbus A message\n'
+
+
+def test_distribute(example_hosts, tmpdir):
+    '''Files are copied to hosts which don't already have them.'''
+
+    source = tmpdir.join('source.txt')
+    source.write('Some data')
+    destination = tmpdir.join('subdir', 'destination.txt')
+
+    TASKS = '''
+    distribute:
+    - source: %s
+      destination: %s
+    tasks: []
+    ''' % (source, destination)
+
+    tasks = nightbus.tasks.TaskList(TASKS)
+
+    client = pssh.ParallelSSHClient(example_hosts, host_config=example_hosts)
+    failed_hosts = nightbus.distribute.distribute_files(
+        client, list(example_hosts), tasks.distribute)
+
+    assert failed_hosts == []
+    assert destination.read() == 'Some data'
+
+    # Now every host has an identical copy, so nothing is sent.
+    destination_mtime = destination.mtime()
+    failed_hosts = nightbus.distribute.distribute_files(
+        client, list(example_hosts), tasks.distribute)
+    assert failed_hosts == []
+    assert destination.mtime() == destination_mtime
+
+
+@pytest.mark.parametrize('options', [
+    {}, {'compress_output': True}, {'detach': True},
+    {'compress_output': True, 'detach': True}])
+def test_fail_on(example_hosts, tmpdir, options):
+    '''A task is stopped as soon as its output matches a fail_on pattern.'''
+
+    TASKS = '''
+    defaults: %s
+    tasks:
+    - name: doomed
+      fail_on: '^FATAL:'
+      commands: |
+        echo "FATAL: something went wrong"
+        sleep 60
+        echo "Still going"
+    ''' % json.dumps(options)
+
+    tasks = nightbus.tasks.TaskList(TASKS)
+
+    client = pssh.ParallelSSHClient(example_hosts, host_config=example_hosts)
+    results = nightbus.tasks.run_all_tasks(
+        client, example_hosts, tasks, log_directory=str(tmpdir))
+
+    report_buffer = io.StringIO()
+    nightbus.tasks.write_report(report_buffer, results)
+    report = report_buffer.getvalue()
+
+    for host in example_hosts:
+        result = results['1.doomed'][host]
+        assert result.exit_code != 0
+        assert result.duration < 60
+        assert result.failure_line == 'FATAL: something went wrong'
+
+        log = tmpdir.join('1.doomed.%s.log' % host).read()
+        assert 'Still going' not in log
+
+    assert 'Stopped after output matched: FATAL: something went wrong' in report
+
+
+def test_run_on(example_hosts, tmpdir):
+    '''Tasks only run on the hosts that match their labels.'''
+
+    TASKS = '''
+    tasks:
+    - name: first-host-only
+      run_on: first
+      commands: echo "hello"
+    '''
+
+    tasks = nightbus.tasks.TaskList(TASKS)
+    first_host = sorted(example_hosts)[0]
+
+    client = pssh.ParallelSSHClient(example_hosts, host_config=example_hosts)
+    results = nightbus.tasks.run_all_tasks(
+        client, example_hosts, tasks, log_directory=str(tmpdir),
+        host_labels={first_host: ['first']})
+
+    assert list(results['1.first-host-only'].keys()) == [first_host]
+    assert os.listdir(str(tmpdir)) == [
+        '1.first-host-only.%s.log' % first_host]
+
+
+def test_run_session(example_hosts, tmpdir):
+    '''Events can be consumed directly while the tasks run.'''
+
+    TASKS = '''
+    tasks:
+    - name: messages
+      commands: |
+        echo "hello"
+        echo "##nightbus A message"
+    '''
+
+    tasks = nightbus.tasks.TaskList(TASKS)
+
+    client = pssh.ParallelSSHClient(example_hosts, host_config=example_hosts)
+    events = list(nightbus.events.run_session(
+        client, example_hosts, tasks, log_directory=str(tmpdir)))
+
+    assert isinstance(events[0], nightbus.events.TaskStarted)
+    assert isinstance(events[-1], nightbus.events.SessionFinished)
+
+    messages = [(event.host, event.message) for event in events
+                if isinstance(event, nightbus.events.MessageReceived)]
+    assert sorted(messages) == [(host, 'A message')
+                                for host in sorted(example_hosts)]
+
+    results = events[-1].results
+    for host in example_hosts:
+        assert results['1.messages'][host].exit_code == 0
@@ -0,0 +1,47 @@
+# Copyright 2017 Codethink Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Unit tests for nightbus.profiling module'''
+
+import gevent
+
+import time
+
+import nightbus
+
+
+def test_profiler(tmpdir):
+    '''Greenlet CPU time and blocking of the hub are recorded.'''
+    def busy_wait(seconds):
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+            pass
+
+    profiler = nightbus.profiling.Profiler(str(tmpdir), blocking_threshold=0.1)
+    profiler.start()
+
+    worker = gevent.spawn(busy_wait, 0.3)
+    worker.name = 'busy-worker'
+    worker.join()
+
+    profiler.stop()
+
+    assert profiler.cpu_time['busy-worker'] >= 0.2
+    assert len(profiler.blocking_reports) == 1
+    assert 'busy_wait' in profiler.blocking_reports[0][2]
+
+    assert tmpdir.join('profile.pstats').exists()
+    summary = tmpdir.join('profile.txt').read()
+    assert 'busy-worker' in summary
+    assert 'Hub blocked for more than 0.100s: 1 times' in summary
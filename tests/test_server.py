@@ -0,0 +1,109 @@
+# Copyright 2017 Codethink Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Unit tests for nightbus.server module'''
+
+import gevent
+import gevent.socket
+
+import json
+
+import nightbus
+
+
+def http_get(server, path):
+    sock = gevent.socket.create_connection(('127.0.0.1', server.server_port))
+    sock.sendall(('GET %s HTTP/1.1\r\nHost: localhost\r\n\r\n' % path).encode())
+    response = b''
+    while True:
+        data = sock.recv(4096)
+        if not data:
+            break
+        response += data
+    sock.close()
+    header, _, body = response.partition(b'\r\n\r\n')
+    return header.decode().splitlines()[0], body.decode()
+
+
+def test_log_buffer_follow():
+    '''Followers see buffered lines, then new lines until the log finishes.'''
+    log_buffer = nightbus.server.LogBuffer('1.task', 'host', 'log', maxlen=2)
+    for line in ['one', 'two', 'three']:
+        log_buffer.append(line)
+
+    follower = gevent.spawn(lambda: list(log_buffer.follow()))
+    gevent.sleep(0)
+    log_buffer.append('four')
+    log_buffer.finish()
+
+    assert follower.get(timeout=1) == [(1, 'two'), (2, 'three'), (3, 'four')]
+    assert list(log_buffer.follow(3)) == [(3, 'four')]
+
+
+def test_status_and_events(tmpdir):
+    '''The server reports status and streams logs as server-sent events.'''
+    tmpdir.join('1.task.host.log').write('hello\nprogress\\rdone\n')
+
+    server = nightbus.server.StatusServer(('127.0.0.1', 0), str(tmpdir))
+    server.start()
+    try:
+        log_buffer = server.open_log('1.task', 'host', '1.task.host.log')
+        log_buffer.append('hello')
+
+        status_line, body = http_get(server, '/')
+        assert status_line == 'HTTP/1.1 200 OK'
+        assert json.loads(body)['tasks']['1.task']['host']['status'] == 'running'
+
+        follower = gevent.spawn(http_get, server, '/events/1.task.host.log')
+        gevent.sleep(0.1)
+        log_buffer.append('progress\rdone')
+        server.finish_log('1.task', 'host')
+        status_line, body = follower.get(timeout=1)
+        assert status_line == 'HTTP/1.1 200 OK'
+        assert body.startswith('id: 0\ndata: hello\n\n'
+                               'id: 1\ndata: progress\ndata: done\n\n')
+
+        # Finished logs are no longer held in memory.
+        assert server.live_buffers == {}
+        status_line, body = http_get(server, '/')
+        assert json.loads(body)['tasks']['1.task']['host']['status'] == 'finished'
+
+        status_line, body = http_get(server, '/events/1.task.host.log')
+        assert status_line == 'HTTP/1.1 200 OK'
+        assert body.startswith('id: 0\ndata: hello\n\n'
+                               'id: 1\ndata: progress\ndata: done\n\n')
+
+        status_line, body = http_get(server, '/logs/1.task.host.log')
+        assert status_line == 'HTTP/1.1 200 OK'
+        assert body == 'hello\nprogress\\rdone\n'
+
+        status_line, body = http_get(server, '/logs/missing.log')
+        assert status_line == 'HTTP/1.1 404 Not Found'
+    finally:
+        server.stop()
+
+
+def test_large_log_file(tmpdir):
+    '''Log files larger than the socket buffers are sent completely.'''
+    data = ''.join('line %i\n' % i for i in range(500000))
+    tmpdir.join('1.task.host.log').write(data)
+
+    server = nightbus.server.StatusServer(('127.0.0.1', 0), str(tmpdir))
+    server.start()
+    try:
+        status_line, body = http_get(server, '/logs/1.task.host.log')
+        assert status_line == 'HTTP/1.1 200 OK'
+        assert body == data
+    finally:
+        server.stop()
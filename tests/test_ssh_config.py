@@ -24,3 +24,33 @@ def test_simple():
     '''
     config = nightbus.ssh_config.SSHConfig(text)
     assert sorted(config.keys()) == ['server_1', 'server_2']
+
+
+def test_labels():
+    text = '''
+    server_1:
+      labels: [ x86_64, linux ]
+    server_2:
+      port: 2222
+      labels: aix
+    server_3:
+    '''
+    config = nightbus.ssh_config.SSHConfig(text)
+    assert config.labels == {'server_1': ['x86_64', 'linux'],
+                             'server_2': ['aix'], 'server_3': []}
+    assert config['server_1'] == {}
+    assert config['server_2'] == {'port': 2222}
+
+
+def test_compress_output():
+    text = '''
+    server_1:
+      compress_output: yes
+    server_2:
+      compress_output: no
+    server_3:
+    '''
+    config = nightbus.ssh_config.SSHConfig(text)
+    assert config.compress_hosts == ['server_1']
+    assert config['server_1'] == {}
+    assert config['server_2'] == {}
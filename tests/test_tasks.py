@@ -16,7 +16,10 @@
 
 import nightbus
 
+import base64
+import gzip
 import os
+import subprocess
 import tempfile
 
 
@@ -138,3 +141,313 @@ def test_parameterize_multiple():
     assert tasklist[1].name == 'test.16.other'
     assert tasklist[2].name == 'test.32.default'
     assert tasklist[3].name == 'test.32.other'
+
+
+def test_compress_output():
+    '''Output compression can be enabled by default and overridden per task.'''
+
+    tasks = '''
+    defaults:
+      compress_output: yes
+    tasks:
+      - name: compressed
+        commands: echo "hello"
+      - name: uncompressed
+        compress_output: no
+        commands: echo "hello"
+    '''
+
+    tasklist = nightbus.tasks.TaskList(tasks)
+
+    assert tasklist[0].compress_output == True
+    assert tasklist[1].compress_output == False
+
+
+def test_compress_output_per_host():
+    '''Hosts can compress output unless the task says otherwise.'''
+
+    tasklist = nightbus.tasks.TaskList('''
+    - name: default
+      commands: echo "hello"
+    - name: compressed
+      compress_output: yes
+      commands: echo "hello"
+    - name: uncompressed
+      compress_output: no
+      commands: echo "hello"
+    ''')
+
+    compress_hosts = ['slow-host']
+    assert [task.compresses_output('slow-host', compress_hosts)
+            for task in tasklist] == [True, True, False]
+    assert [task.compresses_output('fast-host', compress_hosts)
+            for task in tasklist] == [False, True, False]
+
+
+def test_decompress_output():
+    '''Compressed output can arrive as several gzip members.'''
+
+    def encode(data):
+        return base64.encodebytes(gzip.compress(data)).decode('ascii').split()
+
+    lines = (encode(b'first line\nsecond ') + encode(b'line\n') +
+             encode(b'no newline') +
+             [nightbus.tasks.EXIT_STATUS_MARKER + '2'])
+
+    assert list(nightbus.tasks.decompress_output(lines)) == [
+        'first line', 'second line', 'no newline',
+        nightbus.tasks.EXIT_STATUS_MARKER + '2']
+
+
+def test_split_exit_status():
+    '''Only the last line of output can give the exit status.'''
+
+    marker = nightbus.tasks.EXIT_STATUS_MARKER
+    lines = [marker + '5', 'output', marker + 'not a number', marker + '3']
+
+    assert list(nightbus.tasks.split_exit_status(lines)) == [
+        (marker + '5', None), ('output', None),
+        (marker + 'not a number', None), (None, 3)]
+
+    assert list(nightbus.tasks.split_exit_status(['output', marker])) == [
+        ('output', None), (marker, None)]
+
+
+def test_detach():
+    '''Tasks can be set to run detached from the SSH connection.'''
+
+    tasklist = nightbus.tasks.TaskList('''
+    - name: long-running
+      detach: yes
+      commands: make check
+    - name: quick
+      commands: echo "hello"
+    ''')
+
+    assert tasklist[0].detach == True
+    assert tasklist[1].detach == False
+
+
+class LocalClient():
+    '''Stands in for ParallelSSHClient, running commands locally.
+
+    Output lines are stripped and decoded as ParallelSSH does. If
+    `drop_after` is set, the connection drops after that many lines of the
+    output of every command.
+
+    '''
+    def __init__(self, directory, drop_after=None):
+        self.directory = directory
+        self.hosts = []
+        self.drop_after = drop_after
+
+    def run_command(self, cmd, shell=None, stop_on_errors=True):
+        output = subprocess.check_output(['/bin/sh', '-c', cmd],
+                                         cwd=self.directory)
+        lines = [line.strip().decode('utf-8') for line in output.splitlines()]
+        if self.drop_after is not None:
+            lines = self._dropped(lines[:self.drop_after])
+
+        class HostOutput():
+            stdout = iter(lines)
+        return {host: HostOutput() for host in self.hosts}
+
+    def _dropped(self, lines):
+        yield from lines
+        raise OSError("Connection dropped")
+
+    def join(self, output):
+        pass
+
+
+def test_follow_detached(tmpdir, monkeypatch):
+    '''Detached output is followed exactly, even if the connection drops.'''
+
+    monkeypatch.setattr(nightbus.tasks, 'DETACHED_CHUNK_SIZE', 8)
+    monkeypatch.setattr(nightbus.tasks, 'RECONNECT_DELAY', 0)
+
+    log = b'  indented line\ntab\tend\t\n\xff not UTF-8\nno newline'
+    expected = ['  indented line', 'tab\tend\t', '\ufffd not UTF-8',
+                'no newline', nightbus.tasks.EXIT_STATUS_MARKER + '4']
+
+    for compress in [False, True]:
+        for drop_after in [None, 2]:
+            state = tmpdir.mkdir('state-%s-%s' % (compress, drop_after))
+            state.join('log').write_binary(log)
+            state.join('status').write('4\n')
+
+            task = nightbus.tasks.TaskList('''
+            - name: detached
+              detach: yes
+              compress_output: %s
+              commands: echo "hello"
+            ''' % ('yes' if compress else 'no'))[0]
+
+            client = LocalClient(str(tmpdir), drop_after=drop_after)
+            lines = nightbus.tasks.follow_detached(
+                client, 'host', task, state.basename, compress=compress)
+            assert list(lines) == expected
+            assert not state.exists()
+
+
+def test_detached_task_lost(tmpdir, monkeypatch):
+    '''A detached task that disappears without an exit status fails.'''
+
+    monkeypatch.setattr(nightbus.tasks, 'RECONNECT_DELAY', 0)
+
+    process = subprocess.Popen(['true'])
+    process.wait()
+
+    state = tmpdir.mkdir('state')
+    state.join('log').write('started\n')
+    state.join('pid').write('%i\n' % process.pid)
+
+    task = nightbus.tasks.TaskList('''
+    - name: detached
+      detach: yes
+      commands: echo "hello"
+    ''')[0]
+
+    lines = nightbus.tasks.follow_detached(
+        LocalClient(str(tmpdir)), 'host', task, state.basename)
+    assert list(lines) == [
+        'started', 'Night Bus: the task ended without writing its exit status',
+        nightbus.tasks.EXIT_STATUS_MARKER +
+        str(nightbus.tasks.DETACHED_LOST_STATUS)]
+
+
+def test_detached_launch(tmpdir):
+    '''A detached task is started in the background and can be followed.'''
+
+    task = nightbus.tasks.TaskList('''
+    - name: detached
+      detach: yes
+      commands: echo "hello"; exit 3
+    ''')[0]
+
+    client = LocalClient(str(tmpdir))
+    subprocess.check_call(
+        ['/bin/sh', '-c', nightbus.tasks.detached_launch_command(
+            task.script, None, 'state')], cwd=str(tmpdir))
+    assert tmpdir.join('state', 'pid').check()
+
+    lines = nightbus.tasks.follow_detached(client, 'host', task, 'state')
+    assert list(lines) == ['hello', nightbus.tasks.EXIT_STATUS_MARKER + '3']
+
+
+def test_distribute():
+    '''Files can be listed for distribution to the hosts.'''
+
+    tasklist = nightbus.tasks.TaskList('''
+    distribute:
+      - source: toolchain.tar.gz
+      - source: snapshots/gcc.tar
+        destination: /srv/gcc.tar
+        tree: yes
+    tasks:
+      - name: print-hello
+        commands: echo "hello"
+    ''')
+
+    assert [(d.source, d.destination, d.tree) for d in tasklist.distribute] == [
+        ('toolchain.tar.gz', 'toolchain.tar.gz', False),
+        ('snapshots/gcc.tar', '/srv/gcc.tar', True),
+    ]
+
+
+def test_fail_on():
+    '''Failure patterns from the defaults and the task are combined.'''
+
+    tasklist = nightbus.tasks.TaskList('''
+    defaults:
+      fail_on: No space left on device
+    tasks:
+      - name: build
+        fail_on: [ 'internal compiler error', '^FATAL:' ]
+        commands: make
+      - name: test
+        commands: make check
+    ''')
+
+    assert tasklist[0].fail_on.search('FATAL: it broke')
+    assert tasklist[0].fail_on.search('gcc: internal compiler error: Killed')
+    assert tasklist[0].fail_on.search('No space left on device')
+    assert not tasklist[0].fail_on.search('Not FATAL: carry on')
+    assert tasklist[1].fail_on.search('No space left on device')
+    assert not tasklist[1].fail_on.search('FATAL: it broke')
+
+
+def test_run_on():
+    '''Tasks can be limited to hosts with certain labels.'''
+
+    tasklist = nightbus.tasks.TaskList('''
+    defaults:
+      run_on: [ linux ]
+    tasks:
+      - name: linux-only
+        commands: echo "hello"
+      - name: aix-or-host1
+        run_on: [ aix, host1 ]
+        commands: echo "hello"
+      - name: anywhere
+        run_on: []
+        commands: echo "hello"
+    ''')
+
+    linux_only, aix_or_host1, anywhere = tasklist
+
+    assert linux_only.runs_on('host1', ['x86_64', 'linux'])
+    assert not linux_only.runs_on('host2', ['aix'])
+    assert aix_or_host1.runs_on('host1', ['x86_64', 'linux'])
+    assert aix_or_host1.runs_on('host2', ['aix'])
+    assert not aix_or_host1.runs_on('host3', [])
+    assert anywhere.runs_on('host3', [])
+
+
+def test_filter_messages():
+    '''Messages seen on every host are separated from host-specific ones.'''
+
+    results = nightbus.tasks.ResultStore()
+    results.add(nightbus.tasks.TaskResult(
+        '1.test', 'host1', message_list=['start', 'one', 'end']))
+    results.add(nightbus.tasks.TaskResult(
+        '1.test', 'host2', message_list=['start', 'two', 'end', 'extra']))
+
+    global_messages, host_messages = \
+        nightbus.tasks.filter_messages_for_task(results['1.test'])
+
+    assert global_messages == ['start', 'end']
+    assert host_messages == {'host1': ['one'], 'host2': ['two', 'extra']}
+
+
+def test_spill_messages(tmpdir):
+    '''Results with many messages keep them in a file.'''
+
+    spill_directory = tmpdir.join('messages')
+    results = nightbus.tasks.ResultStore(spill_directory=str(spill_directory),
+                                         spill_threshold=2)
+    results.add(nightbus.tasks.TaskResult(
+        '1.test', 'host1', message_list=['one', 'two', 'thr\\ee']))
+    results.add(nightbus.tasks.TaskResult(
+        '1.test', 'host2', message_list=['one']))
+
+    assert spill_directory.listdir() == [
+        spill_directory.join('1.test.host1.messages')]
+    assert results['1.test']['host1'].message_list == ['one', 'two', 'thr\\ee']
+    assert results['1.test']['host2'].message_list == ['one']
+
+
+def test_share_messages():
+    '''Equal messages from different results are stored once.'''
+
+    results = nightbus.tasks.ResultStore()
+    results.add(nightbus.tasks.TaskResult(
+        '1.test', 'host1', message_list=[' '.join(['same', 'message']),
+                                         'one']))
+    results.add(nightbus.tasks.TaskResult(
+        '1.test', 'host2', message_list=[' '.join(['same', 'message'])]))
+
+    host1_message = results['1.test']['host1'].message_list[0]
+    host2_message = results['1.test']['host2'].message_list[0]
+    assert host1_message == host2_message == 'same message'
+    assert host1_message is host2_message